@@ -0,0 +1,142 @@
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    '''
+    Thread-safe in-memory LRU cache where entries also expire after `ttl_seconds`.
+    If `db_path` is given, entries are also written to a SQLite table so they survive restarts,
+    the in-memory layer is then filled from the database on a miss. Values have to be JSON serializable.
+    The table holds at most `max_persistent_size` rows (`max_size` by default): when it grows beyond that,
+    the expired rows are deleted and then the oldest ones. Its row count is kept in memory.
+    '''
+
+    def __init__(
+        self,
+        max_size: int = 10000,
+        ttl_seconds: float = 86400,
+        db_path: str = None,
+        table: str = "cache",
+        max_persistent_size: int = None,
+    ):
+        self.max_size = max_size
+        self.max_persistent_size = max_persistent_size or max_size
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()  # Key -> (created_at, value), least recently used first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.persistent_hits = 0
+        self.table = table
+        self.connection = None
+        self.persistent_count = 0  # Rows in the table
+        if db_path:
+            self.connection = sqlite3.connect(db_path, check_same_thread=False)
+            self.connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self.connection.execute(f"CREATE INDEX IF NOT EXISTS {table}_created_at ON {table} (created_at)")
+            self.persistent_count = self.connection.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            self._evict_persistent(time.time())
+            self.connection.commit()
+
+    def get(self, key):
+        """
+        Get the value of a key, returns None on a miss or if the entry expired
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and now - entry[0] <= self.ttl_seconds:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self.entries[key]
+            entry = self._get_persistent(key, now)
+            if entry is not None:
+                self._put_memory(key, entry)
+                self.hits += 1
+                self.persistent_hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        """
+        Add or replace the value of a key
+        """
+        entry = (time.time(), value)
+        with self.lock:
+            self._put_memory(key, entry)
+            if self.connection is not None:
+                value_json = json.dumps(value)
+                cursor = self.connection.execute(
+                    f"UPDATE {self.table} SET value=?, created_at=? WHERE key=?", (value_json, entry[0], key)
+                )
+                if cursor.rowcount == 0:
+                    self.connection.execute(
+                        f"INSERT INTO {self.table} (key, value, created_at) VALUES (?, ?, ?)",
+                        (key, value_json, entry[0]),
+                    )
+                    self.persistent_count += 1
+                    if self.persistent_count > self.max_persistent_size:
+                        self._evict_persistent(entry[0])
+                self.connection.commit()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            if self.connection is not None:
+                self.connection.execute(f"DELETE FROM {self.table}")
+                self.connection.commit()
+                self.persistent_count = 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "persistent_hits": self.persistent_hits,
+                "persistent_size": self.persistent_count,
+            }
+
+    def _put_memory(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def _get_persistent(self, key, now):
+        if self.connection is None:
+            return None
+        row = self.connection.execute(
+            f"SELECT value, created_at FROM {self.table} WHERE key=?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        if now - row[1] > self.ttl_seconds:
+            self.connection.execute(f"DELETE FROM {self.table} WHERE key=?", (key,))
+            self.connection.commit()
+            self.persistent_count -= 1
+            return None
+        return (row[1], json.loads(row[0]))
+
+    def _evict_persistent(self, now):
+        # Delete the expired rows, then the oldest rows until the table fits in max_persistent_size
+        cursor = self.connection.execute(
+            f"DELETE FROM {self.table} WHERE created_at < ?", (now - self.ttl_seconds,)
+        )
+        self.persistent_count -= cursor.rowcount
+        excess = self.persistent_count - self.max_persistent_size
+        if excess > 0:
+            cursor = self.connection.execute(
+                f"DELETE FROM {self.table} WHERE key IN "
+                f"(SELECT key FROM {self.table} ORDER BY created_at LIMIT ?)",
+                (excess,),
+            )
+            self.persistent_count -= cursor.rowcount
@@ -0,0 +1,61 @@
+def estimate_tokens(text: str) -> int:
+    '''
+    Rough token count of a text, about 4 characters per token for English text.
+    '''
+    return (len(text) + 3) // 4
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    '''
+    Truncate a text to about `max_tokens` tokens, cutting at a word boundary.
+    '''
+    max_chars = max_tokens * 4
+    if len(text) <= max_chars:
+        return text
+    cut = text[:max_chars].rsplit(" ", 1)[0]
+    return cut.rstrip(" ,.;:") + "..."
+
+
+class AgentCatalog:
+    '''
+    Compact description of the agents for the triage prompts.
+    Every agent gets a short card (name, capability and keywords) of at most `max_card_tokens` tokens,
+    and a rendered list of cards never goes over `max_total_tokens` tokens. The cards are built once
+    when the registry is loaded, so the prompt size does not grow with the length of the agent descriptions.
+    '''
+
+    def __init__(self, agents, max_card_tokens: int = 60, max_total_tokens: int = 1500):
+        self.max_card_tokens = max_card_tokens
+        self.max_total_tokens = max_total_tokens
+        self.cards = {agent.name: self._build_card(agent) for agent in agents}
+        self.full_text = self.render(list(self.cards))
+
+    def _build_card(self, agent) -> str:
+        text = " ".join((agent.capability or agent.description or "").split())
+        keywords = agent.specialization_keywords
+        if isinstance(keywords, list):
+            keywords = ", ".join(keywords)
+        if keywords:
+            text = f"{text} Keywords: {keywords}" if text else f"Keywords: {keywords}"
+        return f"{agent.name}: {truncate_to_tokens(text, self.max_card_tokens)}"
+
+    def card(self, agent_name: str) -> str:
+        return self.cards.get(agent_name, agent_name)
+
+    def render(self, agent_names=None) -> str:
+        """
+        Render the cards of the given agents (all agents by default) within the total token budget
+        """
+        if agent_names is None:
+            return self.full_text
+        lines = []
+        used_tokens = 0
+        for i, agent_name in enumerate(agent_names):
+            card = f"- {self.card(agent_name)}"
+            card_tokens = estimate_tokens(card) + 1
+            if used_tokens + card_tokens > self.max_total_tokens:
+                lines.append(f"- ... and {len(agent_names) - i} more agents")
+                break
+            lines.append(card)
+            used_tokens += card_tokens
+        return "\n".join(lines)
@@ -0,0 +1,60 @@
+from collections import deque
+from langchain_core.messages import SystemMessage
+from agent.catalog import estimate_tokens, truncate_to_tokens
+
+
+def extractive_summary(summary: str, message, max_summary_tokens: int) -> str:
+    '''
+    Fold a message into the rolling summary by appending a shortened copy of it.
+    When the summary goes over its budget the oldest sentences are dropped first.
+    '''
+    role = "User" if message.type == "human" else "Assistant"
+    line = f"{role}: {truncate_to_tokens(' '.join(message.content.split()), 40)}"
+    lines = summary.split("\n") if summary else []
+    lines.append(line)
+    while len(lines) > 1 and estimate_tokens("\n".join(lines)) > max_summary_tokens:
+        lines.pop(0)
+    return "\n".join(lines)
+
+
+class ConversationHistory:
+    '''
+    Conversation history with a token budget.
+    The most recent messages are kept verbatim as long as they fit in `max_tokens`; older messages are
+    folded one at a time into a rolling summary of at most `max_summary_tokens` tokens, so the history sent
+    to the model stays the same size however long the conversation gets.
+    `summarizer(summary, message, max_summary_tokens)` can be replaced, e.g. by an LLM based summary.
+    '''
+
+    def __init__(self, max_tokens: int = 1500, max_summary_tokens: int = 300, summarizer=extractive_summary):
+        self.max_tokens = max_tokens
+        self.max_summary_tokens = max_summary_tokens
+        self.summarizer = summarizer
+        self.recent = deque()  # (message, tokens) of the messages kept verbatim, oldest first
+        self.recent_tokens = 0
+        self.summary = ""
+
+    def add(self, message):
+        """
+        Add a message, folding the oldest messages into the summary when the budget is exceeded
+        """
+        tokens = estimate_tokens(message.content)
+        self.recent.append((message, tokens))
+        self.recent_tokens += tokens
+        # The newest message is always kept, even if it is over the budget on its own
+        while len(self.recent) > 1 and self.recent_tokens > self.max_tokens:
+            old_message, old_tokens = self.recent.popleft()
+            self.recent_tokens -= old_tokens
+            self.summary = self.summarizer(self.summary, old_message, self.max_summary_tokens)
+
+    def messages(self) -> list:
+        """
+        The messages to send to the model: the summary of the older messages followed by the recent ones
+        """
+        messages = [message for message, _ in self.recent]
+        if self.summary:
+            messages.insert(0, SystemMessage(content=f"Summary of the earlier conversation:\n{self.summary}"))
+        return messages
+
+    def __len__(self):
+        return len(self.recent)
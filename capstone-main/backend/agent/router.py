@@ -0,0 +1,207 @@
+import os
+import re
+import glob
+import math
+from collections import Counter
+import numpy as np
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text: str) -> list:
+    '''
+    Lowercased word unigrams and bigrams of a text.
+    '''
+    words = TOKEN_PATTERN.findall(text.lower())
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+
+class Tier0Router:
+    '''
+    Lightweight query classifier which routes queries before any LLM call.
+    Queries are turned into TF-IDF vectors and scored by a softmax regression, which only needs a few
+    array lookups per query on CPU. A prediction is only accepted when its probability is at least
+    `threshold`, calibrated on held-out data so the accepted predictions reach a target precision.
+    '''
+
+    def __init__(self, vocabulary, idf, weights, bias, labels, threshold, version=1):
+        self.vocabulary = {term: i for i, term in enumerate(vocabulary)}  # Term -> feature index
+        self.idf = np.asarray(idf, dtype=np.float32)
+        self.weights = np.asarray(weights, dtype=np.float32)  # (features, labels)
+        self.bias = np.asarray(bias, dtype=np.float32)
+        self.labels = list(labels)
+        self.threshold = float(threshold)
+        self.version = int(version)
+
+    def _features(self, text):
+        # Sparse L2-normalized TF-IDF vector of a text as (indices, values)
+        counts = Counter(
+            self.vocabulary[term] for term in tokenize(text) if term in self.vocabulary
+        )
+        if not counts:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        indices = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+        values = np.fromiter(counts.values(), dtype=np.float32, count=len(counts)) * self.idf[indices]
+        return indices, values / np.linalg.norm(values)
+
+    def predict_proba(self, text) -> np.ndarray:
+        indices, values = self._features(text)
+        logits = values @ self.weights[indices] + self.bias
+        logits -= logits.max()
+        probabilities = np.exp(logits)
+        return probabilities / probabilities.sum()
+
+    def predict(self, text):
+        """
+        Returns the most likely label and its probability
+        """
+        probabilities = self.predict_proba(text)
+        best = int(np.argmax(probabilities))
+        return self.labels[best], float(probabilities[best])
+
+    def route(self, text):
+        """
+        Returns the predicted label if its probability passes the calibrated threshold, otherwise None.
+        A text without any known term (e.g. "Hello") is never routed: its prediction would only be the label prior.
+        """
+        if not any(term in self.vocabulary for term in tokenize(text)):
+            return None
+        label, probability = self.predict(text)
+        return label if probability >= self.threshold else None
+
+    def save(self, path):
+        np.savez(
+            path,
+            vocabulary=np.array(sorted(self.vocabulary, key=self.vocabulary.get)),
+            idf=self.idf,
+            weights=self.weights,
+            bias=self.bias,
+            labels=np.array(self.labels),
+            threshold=np.array(self.threshold),
+            version=np.array(self.version),
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            return cls(
+                vocabulary=data["vocabulary"].tolist(),
+                idf=data["idf"],
+                weights=data["weights"],
+                bias=data["bias"],
+                labels=data["labels"].tolist(),
+                threshold=data["threshold"].item(),
+                version=data["version"].item(),
+            )
+
+    @classmethod
+    def load_latest(cls, directory):
+        """
+        Load the artifact with the highest version from a directory, returns None if there is none
+        """
+        paths = glob.glob(os.path.join(directory, "tier0_router_v*.npz"))
+        if not paths:
+            return None
+        return cls.load(max(paths, key=artifact_version))
+
+
+def artifact_version(path) -> int:
+    match = re.search(r"tier0_router_v(\d+)\.npz$", path)
+    return int(match.group(1)) if match else 0
+
+
+def train_router(
+    questions,
+    labels,
+    max_features=20000,
+    min_df=2,
+    epochs=30,
+    learning_rate=5.0,
+    l2=1e-4,
+    batch_size=256,
+    holdout=0.2,
+    target_precision=0.95,
+    seed=0,
+    version=1,
+):
+    '''
+    Fit a Tier0Router on labeled questions.
+    A random `holdout` share of the data is kept aside to calibrate the acceptance threshold: the lowest
+    probability at which the held-out predictions above it still reach `target_precision`.
+    The returned router is the one the threshold was calibrated on, it is not refit on all the data since a
+    refit model has different probabilities. Returns the router and a dict of held-out statistics.
+    '''
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(questions))
+    n_holdout = int(len(questions) * holdout)
+    holdout_idx, train_idx = order[:n_holdout], order[n_holdout:]
+
+    router = _fit([questions[i] for i in train_idx], [labels[i] for i in train_idx],
+                  max_features, min_df, epochs, learning_rate, l2, batch_size, rng, version)
+    router.threshold, stats = _calibrate(
+        router, [questions[i] for i in holdout_idx], [labels[i] for i in holdout_idx], target_precision
+    )
+    return router, stats
+
+
+def _fit(questions, labels, max_features, min_df, epochs, learning_rate, l2, batch_size, rng, version):
+    # Vocabulary of the most frequent terms by document frequency
+    document_frequency = Counter()
+    for question in questions:
+        document_frequency.update(set(tokenize(question)))
+    terms = [term for term, df in document_frequency.most_common(max_features) if df >= min_df]
+    idf = np.array(
+        [math.log((1 + len(questions)) / (1 + document_frequency[term])) + 1 for term in terms],
+        dtype=np.float32,
+    )
+    label_names = sorted(set(labels))
+    router = Tier0Router(
+        terms, idf, np.zeros((len(terms), len(label_names))), np.zeros(len(label_names)),
+        label_names, threshold=1.0, version=version,
+    )
+    label_index = {label: i for i, label in enumerate(label_names)}
+    features = [router._features(question) for question in questions]
+    targets = np.array([label_index[label] for label in labels])
+
+    # Mini-batch gradient descent on the softmax cross-entropy, batches are densified one at a time
+    weights = router.weights
+    bias = router.bias
+    for _ in range(epochs):
+        order = rng.permutation(len(questions))
+        for start in range(0, len(questions), batch_size):
+            rows = order[start:start + batch_size]
+            x = np.zeros((len(rows), len(terms)), dtype=np.float32)
+            for r, i in enumerate(rows):
+                indices, values = features[i]
+                x[r, indices] = values
+            logits = x @ weights + bias
+            logits -= logits.max(axis=1, keepdims=True)
+            probabilities = np.exp(logits)
+            probabilities /= probabilities.sum(axis=1, keepdims=True)
+            probabilities[np.arange(len(rows)), targets[rows]] -= 1
+            weights -= learning_rate * (x.T @ probabilities / len(rows) + l2 * weights)
+            bias -= learning_rate * probabilities.mean(axis=0)
+    return router
+
+
+def _calibrate(router, questions, labels, target_precision):
+    # Lowest threshold for which the held-out predictions above it reach the target precision
+    if not questions:
+        return 1.0, {"holdout": 0, "accuracy": None, "coverage": 0.0}
+    predictions = [router.predict(question) for question in questions]
+    probabilities = np.array([probability for _, probability in predictions])
+    correct = np.array([label == true for (label, _), true in zip(predictions, labels)])
+    order = np.argsort(-probabilities)
+    precision = np.cumsum(correct[order]) / np.arange(1, len(order) + 1)
+    passing = np.flatnonzero(precision >= target_precision)
+    if passing.size == 0:
+        threshold, coverage = 1.01, 0.0  # Never accept a prediction
+    else:
+        threshold = float(probabilities[order][passing[-1]])
+        coverage = float((probabilities >= threshold).mean())
+    return threshold, {
+        "holdout": len(questions),
+        "accuracy": float(correct.mean()),
+        "threshold": threshold,
+        "coverage": coverage,
+    }
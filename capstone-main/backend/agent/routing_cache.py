@@ -0,0 +1,103 @@
+import time
+import threading
+import numpy as np
+
+
+class SemanticRoutingCache:
+    '''
+    Cache of routing decisions which also matches paraphrases of queries that were already routed.
+    Query embeddings are kept in a fixed-size float32 matrix; a lookup is a single matrix-vector product
+    and the stored decision is reused when the cosine similarity of the nearest query is above `similarity_threshold`.
+    Decisions are partitioned by the agent the conversation was at (the same query can route differently
+    from another agent), expire after `ttl_seconds` and are dropped when the agent registry changes.
+    '''
+
+    def __init__(self, max_size: int = 5000, similarity_threshold: float = 0.95, ttl_seconds: float = 3600):
+        self.max_size = max_size
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.registry_version = 0  # Increased every time agents are added or changed
+        self.lock = threading.Lock()
+        self.vectors = None  # (max_size, dim) matrix of normalized query embeddings, allocated on the first add
+        self.in_use = np.zeros(max_size, dtype=bool)
+        self.partitions = np.full(max_size, -1, dtype=np.int32)
+        self.created_at = np.zeros(max_size, dtype=np.float64)
+        self.last_used = np.zeros(max_size, dtype=np.float64)
+        self.decisions = [None] * max_size
+        self.partition_ids = {}  # Partition name -> id stored in self.partitions
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, query_vector, partition: str):
+        """
+        Return the decision of the most similar cached query of the partition, or None if there is none close enough
+        """
+        vector = self._normalize(query_vector)
+        now = time.time()
+        with self.lock:
+            partition_id = self.partition_ids.get(partition)
+            if self.vectors is None or partition_id is None:
+                self.misses += 1
+                return None
+            candidates = np.flatnonzero(
+                self.in_use
+                & (self.partitions == partition_id)
+                & (now - self.created_at <= self.ttl_seconds)
+            )
+            if candidates.size == 0:
+                self.misses += 1
+                return None
+            similarities = self.vectors[candidates] @ vector
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.similarity_threshold:
+                self.misses += 1
+                return None
+            slot = candidates[best]
+            self.last_used[slot] = now
+            self.hits += 1
+            return self.decisions[slot]
+
+    def add(self, query_vector, partition: str, decision: dict, registry_version: int = None):
+        """
+        Cache the routing decision of a query, evicting the least recently used entry when the cache is full.
+        If `registry_version` is given and the registry changed since then, the decision is outdated and not cached.
+        """
+        vector = self._normalize(query_vector)
+        now = time.time()
+        with self.lock:
+            if registry_version is not None and registry_version != self.registry_version:
+                return
+            if self.vectors is None:
+                self.vectors = np.zeros((self.max_size, vector.shape[0]), dtype=np.float32)
+            free = np.flatnonzero(~self.in_use)
+            slot = int(free[0]) if free.size else int(np.argmin(self.last_used))
+            partition_id = self.partition_ids.setdefault(partition, len(self.partition_ids))
+            self.vectors[slot] = vector
+            self.in_use[slot] = True
+            self.partitions[slot] = partition_id
+            self.created_at[slot] = now
+            self.last_used[slot] = now
+            self.decisions[slot] = dict(decision)  # Copy, the caller may add per-session fields to its response
+
+    def invalidate(self):
+        """
+        Drop all cached decisions, called when the agent registry changes
+        """
+        with self.lock:
+            self.registry_version += 1
+            self.in_use[:] = False
+            self.decisions = [None] * self.max_size
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "size": int(self.in_use.sum()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "registry_version": self.registry_version,
+            }
+
+    def _normalize(self, vector):
+        vector = np.asarray(vector, dtype=np.float32).ravel()
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
@@ -0,0 +1,119 @@
+import time
+import asyncio
+import uuid
+import threading
+from collections import OrderedDict, deque
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from agent.history import ConversationHistory
+from agent.catalog import truncate_to_tokens
+
+
+class SessionState:
+    '''
+    Per-conversation state of the triage agent.
+    Only the mutable parts of a conversation live here (the token-budgeted history, a compact log of the
+    model calls and the current agent), the LLM clients, databases and agent registry are shared through
+    the TriageAgent. The prompts themselves are never kept, so a session stays a few kilobytes.
+    '''
+
+    def __init__(self, session_id: str, current_agent=None, history_max_tokens: int = 1500, max_log_entries: int = 50):
+        self.session_id = session_id
+        self.conversation_history = ConversationHistory(
+            max_tokens=history_max_tokens
+        )  # Token-budgeted history of the user queries and routing decisions
+        self.generated_conversation_log = deque(
+            maxlen=max_log_entries
+        )  # One short "stage: query -> answer" line per model call, the latest calls only
+        self.current_agent = current_agent  # The current agent of this conversation
+        self.last_access = time.monotonic()
+        self.lock = asyncio.Lock()  # Requests of the same session are handled one at a time
+
+    def add_turn(self, query, response):
+        """
+        Add a finished turn to the conversation history: the user query and the routing decision
+        """
+        self.conversation_history.add(HumanMessage(content=query))
+        self.conversation_history.add(AIMessage(content=response))
+
+    def build_messages(self, system_prompt, query):
+        """
+        Build the messages of a single model call: the conversation history followed by the system prompt and the query.
+        The messages only exist for the call, the conversation history is not changed,
+        so several calls of the same session can run at the same time.
+        """
+        return self.conversation_history.messages() + [
+            SystemMessage(content=system_prompt),
+            HumanMessage(content=query),
+        ]
+
+    def log_call(self, stage, query, answer):
+        """
+        Add a model call to the generated conversation log, the query and the answer are shortened
+        """
+        self.generated_conversation_log.append(
+            f"{stage}: {truncate_to_tokens(query, 40)} -> {truncate_to_tokens(str(answer), 20)}"
+        )
+
+    def get_conversation_history(self):
+        """
+        Get the conversation history
+        """
+        return self.conversation_history.messages()
+
+    def get_generated_conversation_log(self):
+        """
+        Get the generated conversation log, a list of strings
+        """
+        return list(self.generated_conversation_log)
+
+
+class SessionStore:
+    '''
+    Session-keyed store of SessionState objects.
+    Sessions are kept in least recently used order; a session is evicted when it has not been
+    used for `ttl_seconds` or when the store grows beyond `max_sessions`, so memory stays bounded.
+    '''
+
+    def __init__(self, max_sessions: int = 10000, ttl_seconds: float = 3600):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_or_create(self, session_id, factory) -> SessionState:
+        """
+        Get the session with the given id or create a new one with `factory(session_id)`.
+        A new session id is generated if none is provided, an unknown id gets a new session under that id.
+        """
+        now = time.monotonic()
+        with self.lock:
+            self._evict_expired(now)
+            session = self.sessions.get(session_id) if session_id else None
+            if session is None:
+                session_id = session_id or str(uuid.uuid4())
+                session = factory(session_id)
+                self.sessions[session_id] = session
+                while len(self.sessions) > self.max_sessions:
+                    self.sessions.popitem(last=False)
+            else:
+                self.sessions.move_to_end(session_id)
+            session.last_access = now
+            return session
+
+    def delete(self, session_id) -> bool:
+        """
+        Delete a session, returns True if the session existed
+        """
+        with self.lock:
+            return self.sessions.pop(session_id, None) is not None
+
+    def _evict_expired(self, now):
+        # Sessions are ordered by last access so the expired ones are always at the front
+        while self.sessions:
+            session_id, session = next(iter(self.sessions.items()))
+            if now - session.last_access <= self.ttl_seconds:
+                break
+            self.sessions.popitem(last=False)
+
+    def __len__(self):
+        return len(self.sessions)
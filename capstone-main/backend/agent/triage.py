@@ -1,44 +1,130 @@
+import os
+import re
 import json
-from langchain_openai import ChatOpenAI
-from langchain_core.messages import HumanMessage, SystemMessage
+import asyncio
+import hashlib
+from collections import Counter
 from database.database import SQLLiteDatabase
-from database.vector_store import SQLLiteVectorStore, ChromaDBVectorStore
+from database.vector_store import ChromaDBVectorStore
+from agent.session import SessionState
+from agent.catalog import AgentCatalog
+from agent.router import Tier0Router
+from database.keyword_index import KeywordIndex, reciprocal_rank_fusion
+from database.agent_index import matches_filter
 from pydantic import BaseModel, Field
 from typing import List
 
 
 class TriageAgent:
-    def __init__(self, model="qwen2.5-coder-7b-instruct", temperature=0):
+    '''
+    Triage agent which routes user queries to the most relevant agent.
+    The LLM clients, databases and agent registry are shared and only read while handling a query,
+    everything that belongs to a single conversation is kept in a SessionState passed to each method.
+    '''
+
+    def __init__(
+        self,
+        model="qwen2.5-coder-7b-instruct",
+        temperature=0,
+        speculative=False,
+        fast_path_max_distance=0.8,
+        fast_path_min_margin=0.2,
+        rewrite_cache=None,
+        routing_cache=None,
+        remember_turns=False,
+        history_max_tokens=1500,
+        fused=False,
+        router_dir=None,
+        keywords_path=None,
+        max_candidates=5,
+        use_agent_index=True,
+        vector_store_factory=None,
+        agent_filter=None,
+    ):
         self.model = model
         self.temperature = temperature
+        # In speculative mode the vector search starts on the raw query while the query is being rewritten
+        # and the agent selection runs at the same time as the can-answer check
+        self.speculative = speculative
+        # The agent selection skips the LLM when the top agent of the vector search is closer than fast_path_max_distance
+        # and at least fast_path_min_margin closer than the next agent. Set fast_path_max_distance to None to disable it.
+        self.fast_path_max_distance = fast_path_max_distance
+        self.fast_path_min_margin = fast_path_min_margin
+        # Optional LRUCache of query rewrites (including $CLARIFY), keyed on the normalized query and the model/prompt version
+        # Only first turns are cached, follow-up rewrites depend on the conversation history of their session
+        self.rewrite_cache = rewrite_cache
+        # Optional SemanticRoutingCache which reuses the routing decision of near-duplicate queries, on first turns only
+        self.routing_cache = routing_cache
+        # Keep the past turns of a session and send them with every model call, so follow-ups like
+        # "what about the other one?" can be resolved. Off by default: the history adds up to history_max_tokens
+        # of prefill to each call and follow-up turns bypass the rewrite and routing caches.
+        self.remember_turns = remember_turns
+        # Token budget of the conversation history when remember_turns is on, older turns are summarized
+        self.history_max_tokens = history_max_tokens
+        self.metrics = Counter()  # Counters of the triage pipeline, e.g. speculative calls and wasted calls
         self.llm = None  # LLM config instance for selecting the appropriate agent
         self.clarification_llm = (
             None  # LLM config instance for asking for clarification
         )
-        self.conversation_history = []  # List of messages in the conversation
-        self.generated_conversation_log = (
-            []
-        )  # List of actual messages in the conversation which include system and human messages
-        self.current_agent = None  # The current agent
+        self.chat_model = None  # Chat model the structured LLMs are built from, the fused triage builds one per query
+        self.fused_json_schema = None  # JSON schema of the fused triage, its agent enum is set per query
+        self.selection_json_schema = None  # JSON schema of the agent selection, its agent enum holds the usable agents
+        # In fused mode the rewrite, the clarify decision, the can-answer check and the agent selection are done
+        # in a single structured call over candidates pre-fetched by the vector search
+        self.fused = fused
+        # Directory of the trained tier-0 router artifacts, the latest version is loaded in load_agent.
+        # Its confident predictions route the query before any LLM call.
+        self.router_dir = router_dir
+        self.router = None
+        # JSON file of extra weighted terms per agent (e.g. word2vec representative words) for the keyword index
+        self.keywords_path = keywords_path
+        self.keyword_index = None  # Inverted index of the agent keywords, built in load_agent
+        self.extra_terms = {}  # Extra weighted terms per agent read from keywords_path, kept to rebuild the keyword index
+        self.max_candidates = max_candidates  # Maximum number of candidate agents given to the agent selection
+        # Search the agents in an in-memory index of one vector per agent instead of the chunks in Chroma
+        self.use_agent_index = use_agent_index
+        # Optional callable which opens the vector store in load_agent, the Chroma store is used by default
+        self.vector_store_factory = vector_store_factory
+        # Attributes an agent needs to be routed to, applied in the vector search before the top-k
+        self.agent_filter = agent_filter if agent_filter is not None else {"online": True, "is_public": True}
+        self.usable_agents = set()  # Names of the agents which match agent_filter, set in load_agent
         self.agents = ["$OTHER_AGENT"]  # List of agents
-        self.db = SQLLiteDatabase(
-            "database/sqllite.db"
-        )  # Database instance which stores the agent names
-        self.vector_db = ChromaDBVectorStore(
-            "database/chromadb"
-        )  # Vector database instance
+        self.catalog = None  # Compact agent cards used in the prompts, built in load_agent
+        self.usable_catalog = ""  # Rendered cards of the usable agents, for the can-answer prompt
+        self.registry_version = None  # Version of the agent registry self.agents was loaded from
+        self.db = None  # Database instance which stores the agent names, opened in load_agent
+        self.vector_db = None  # Vector database instance, opened in load_agent
 
     def load_agent(self):
         # Read all metadata files from agent metadata directory
         # Load each metadata file into an agent
-        self.llm = ChatOpenAI(
+        # The clients are created here instead of in __init__ so that creating the agent is cheap
+        # and the slow part can run in a background warmup task
+        from langchain_openai import ChatOpenAI
+
+        self.db = SQLLiteDatabase("database/sqllite.db")
+        if self.vector_store_factory is not None:
+            self.vector_db = self.vector_store_factory()
+        else:
+            self.vector_db = ChromaDBVectorStore("database/chromadb", use_agent_index=self.use_agent_index)
+        self.vector_db.warmup()
+        self.chat_model = ChatOpenAI(
             model=self.model,
             temperature=self.temperature,
             model_kwargs={
                 "response_format": "json_schema",
             },
         )
-        self.agents = self.db.get_all_agents()
+        if self.keywords_path and os.path.exists(self.keywords_path):
+            with open(self.keywords_path, encoding="utf-8") as file:
+                self.extra_terms = json.load(file)
+        self.registry_version = self.db.get_registry_version()
+        agents = self.db.get_all_agents()
+        self._load_agents(agents, agents)
+        if self.router_dir:
+            self.router = Tier0Router.load_latest(self.router_dir)
+            if self.router is not None:
+                print(f"Loaded tier-0 router version {self.router.version}")
 
         # Define the JSON schema for the query clarification
         other_json_schema = {
@@ -49,228 +135,689 @@ class TriageAgent:
             "additionalProperties": False,
         }
 
-        self.clarification_llm = self.llm.with_structured_output(
+        self.clarification_llm = self.chat_model.with_structured_output(
             other_json_schema, method="json_schema"
         )
 
-        # Define the JSON schema for the agent selection
-        json_schema = {
+        # Define the JSON schema for the agent selection.
+        # The agent enum is filled with the usable agents, see _selection_llm
+        self.selection_json_schema = {
             "title": "Agent Selection",
             "description": "Schema for selecting the appropriate agent based on the query.",
             "type": "object",
+            "properties": {"agent": {"type": "string"}},
+            "additionalProperties": False,
+        }
+
+        # Define the JSON schema for the fused triage, which answers all the triage questions at once.
+        # The agent enum is filled with the candidates of each query, see _fused_llm
+        self.fused_json_schema = {
+            "title": "Fused Triage",
+            "description": "Schema for rewriting the query, asking for clarification and selecting the appropriate agent in one step.",
+            "type": "object",
             "properties": {
-                "agent": {
-                    "type": "string",
-                    "enum": [agent.name for agent in self.agents],
-                }
+                "clarify": {"type": "boolean"},
+                "rewritten_query": {"type": "string"},
+                "current_agent_can_answer": {"type": "boolean"},
+                "agent": {"type": "string"},
             },
+            "required": ["clarify", "rewritten_query", "current_agent_can_answer", "agent"],
             "additionalProperties": False,
         }
 
-        self.llm = self.llm.with_structured_output(json_schema, method="json_schema")
-        self.current_agent = self.agents[0]
+        self.llm = self._selection_llm()
+
+    def _load_agents(self, agents, changed_agents):
+        # Use a new list of agents: copy the filter attributes of the changed agents to the agent vectors
+        # and rebuild everything which depends on the agents
+        for agent in changed_agents:
+            self.vector_db.set_agent_attributes(agent.name, agent.filter_attributes())
+        self.agents = agents
+        self.catalog = AgentCatalog(agents)
+        self.keyword_index = KeywordIndex(agents, extra_terms=self.extra_terms)
+        self.usable_agents = {
+            agent.name for agent in agents if matches_filter(agent.filter_attributes(), self.agent_filter)
+        }
+        self.usable_catalog = self.catalog.render(
+            [agent.name for agent in agents if agent.name in self.usable_agents]
+        )
+        if self.selection_json_schema is not None:
+            self.llm = self._selection_llm()
 
-    def add_human_message(self, message):
+    def refresh_agents(self) -> bool:
         """
-        Add a human message to the conversation history
+        Reload the agents if the registry changed since they were loaded, also when it was changed directly
+        in the database. Only the agents whose filter attributes changed are written to the vector store,
+        and cached routing decisions are dropped. Returns whether the agents were reloaded.
         """
-        human_message = HumanMessage(content=message)
-        self.conversation_history.append(human_message)
-        self.generated_conversation_log.append(human_message)
+        registry_version = self.db.get_registry_version()
+        if registry_version == self.registry_version:
+            return False
+        self.registry_version = registry_version
+        previous = {agent.name: agent.filter_attributes() for agent in self.agents}
+        agents = self.db.get_all_agents()
+        changed = [agent for agent in agents if previous.get(agent.name) != agent.filter_attributes()]
+        self._load_agents(agents, changed)
+        if self.routing_cache is not None:
+            self.routing_cache.invalidate()
+        return True
 
-    def add_system_message(self, message):
+    def _selection_llm(self):
         """
-        Add a system message to the conversation history
+        Structured LLM of the agent selection whose agent enum holds the usable agents,
+        or every agent if none is usable as the enum cannot be empty
         """
-        system_message = SystemMessage(content=message)
-        self.conversation_history.append(system_message)
-        self.generated_conversation_log.append(system_message)
+        names = [agent.name for agent in self.agents if agent.name in self.usable_agents]
+        schema = dict(self.selection_json_schema)
+        schema["properties"] = {
+            "agent": {"type": "string", "enum": names or [agent.name for agent in self.agents]}
+        }
+        return self.chat_model.with_structured_output(schema, method="json_schema")
 
-    def remove_last_system_message(self):
+    def _default_agent(self):
         """
-        Remove the last system message from the conversation history
+        The agent new sessions start with: the first usable agent of the registry,
+        or the first agent if none is usable
         """
-        for i in range(len(self.conversation_history) - 1, -1, -1):
-            if isinstance(self.conversation_history[i], SystemMessage):
-                self.conversation_history.pop(i)
-                break
+        for agent in self.agents:
+            if agent.name in self.usable_agents:
+                return agent
+        return self.agents[0]
 
-    def remove_last_human_message(self):
+    def _usable_agent_name(self, selected_agent, agents):
         """
-        Remove the last human message from the conversation history
+        The selected agent if it is usable, otherwise the best candidate or the default agent
         """
-        for i in range(len(self.conversation_history) - 1, -1, -1):
-            if isinstance(self.conversation_history[i], HumanMessage):
-                self.conversation_history.pop(i)
-                break
+        if selected_agent in self.usable_agents:
+            return selected_agent
+        self.metrics["unusable_selections"] += 1
+        return agents[0].name if agents else self._default_agent().name
 
-    def get_conversation_history(self):
+    def update_agent_status(self, agent_name, online=None, is_public=None) -> bool:
         """
-        Get the conversation history
+        Change the online and/or is_public flags of an agent in the registry and in the agent search filter.
+        Cached routing decisions are dropped as they may point to an agent which is not usable anymore.
+        Returns False if there is no such agent.
         """
-        return self.conversation_history
+        if not self.db.set_agent_status(agent_name, online=online, is_public=is_public):
+            return False
+        self.refresh_agents()
+        return True
 
-    def get_generated_conversation_log(self):
+    def new_session(self, session_id):
         """
-        Get the generated conversation log
+        Create the state of a new conversation, starting with the default agent
         """
-        return self.generated_conversation_log
+        return SessionState(
+            session_id,
+            current_agent=self._default_agent(),
+            history_max_tokens=self.history_max_tokens,
+        )
 
-    def set_current_agent(self, agent_name):
+    def set_current_agent(self, session, agent_name):
         """
-        Set the current agent based on the agent name provided
-        This method goes through the list of agents and sets the current agent to the one with the matching name
+        Set the current agent of the session based on the agent name provided
+        The agent is looked up in the cached agent registry,
         if the agent is not found, it raises a ValueError
         """
-        agent = None
-        for a in self.agents:
-            if a.name == agent_name:
-                agent = a
-                break
-        if not agent:
+        agents = self.db.get_agents([agent_name])
+        if not agents:
             raise ValueError(f"Agent with name {agent_name} not found.")
-        self.current_agent = agent
+        session.current_agent = agents[0]
 
-    def generate_better_query_or_ask_for_clarification(self, query):
+    async def _ainvoke(self, llm, session, stage, system_prompt, query):
         """
-        Generate a better query or ask for clarification based on the user query
+        Invoke the LLM on the conversation history followed by the system prompt and the query,
+        without blocking the event loop. The call is only recorded in the generated conversation log
+        of the session, as its stage, query and answer, once it returns, so cancelled calls leave no trace.
         """
-        self.add_system_message(
-            f"""Generate a better query or ask for clarification based on the user query. 
+        messages = session.build_messages(system_prompt, query)
+        res = await llm.ainvoke(messages)
+        session.log_call(stage, query, res)
+        return res
+
+    def _clarification_prompt(self, query):
+        return f"""Generate a better query or ask for clarification based on the user query. 
                 Usually, if the query is a sensible sentence and not jargon or has some sensible keywords, then it is okay to proceed with the query.
                 If you think the query is like "what is the internet" or "what is a computer", "Hello", "How are you", then it is better to ask for clarification and return $CLARIFY.
                 If you think the query is not clear and doesn't make sense or have enough context for a RAG model to answer, return $CLARIFY.
                 If you think the query is okay - write the query in a format which will perform better in the RAG model.
                 In any case, do not response empty or with a single word. Always provide a sensible response.
                 Now, if the query is OKAY, rewrite the query and return that as the response. If the query is not okay, return $CLARIFY. Like re-write the user query instead of answering the question.
-                The user query is: {query}""",
-        )
-        self.add_human_message(query)
-        res = self.clarification_llm.invoke(self.conversation_history)
+                The user query is: {query}"""
 
-        # This removes the messages to keep the conversation history clean
-        self.remove_last_system_message()
-        self.remove_last_human_message()
-        return res["text"]
-
-    def check_if_current_agent_can_answer(self, query) -> bool:
-        """
-        Check if the current agent can answer the query.
-        This will return True if the current agent can answer the query
-        and False if the current agent cannot answer the query.
-        """
-        self.add_system_message(
-            f"""Determine if the question needs a redirection to another agent or the current agent is capable of answering it. 
+    def _can_answer_prompt(self, session):
+        return f"""Determine if the question needs a redirection to another agent or the current agent is capable of answering it. 
                 If the current agent is capable of answering it, then proceed with the current agent.
                 Usually, internet_search is not the answer and try to use more of the specialized agents which we have
-                The current agent is {str(self.current_agent)}. Here are the other agents for your context. {str(self.agents)} - DO NOT USE THESE NAMES IN THE RESPONSE.
+                The current agent is {self.catalog.card(session.current_agent.name)}. Here are the other agents for your context.
+                {self.usable_catalog}
+                - DO NOT USE THESE NAMES IN THE RESPONSE.
                 Usually, if the current agent is a specialized agent, then it is better to proceed with the current agent.
                 So for example, if the current agent is 'agent1', then the response should be 'agent1' or '$OTHER_AGENT' to switch to another agent. 
                 ONLY ANSWER WITH THE CURRENT AGENT NAME OR $OTHER_AGENT. DO NOT ANSWER WITH ANY OTHER AGENT NAME. Be intelligent and think if the current agent can answer the question or not.
                 BE VERY STRICT AND CAREFUL THINKING IF THE CURRENT AGENT CAN ANSWER THE QUESTION OR NOT. IT IS OKAY TO SWITCH IF IN DOUBT.
-        """,
-        )
-        self.add_human_message(query)
-        res = self.llm.invoke(self.conversation_history)
-        json_res = res
+        """
+
+    def _can_answer_from_response(self, session, json_res) -> bool:
         print("FIRST STEP: ", json_res)
-        self.remove_last_system_message()
-        self.remove_last_human_message()
-        if json_res["agent"] == self.current_agent.name:
+        if json_res["agent"] == session.current_agent.name:
             return True
         if json_res["agent"] == "$OTHER_AGENT":
             return False
         return False
 
-    def get_relevant_agents(self, query):
+    def _agent_selection_prompt(self, session, query, results):
         """
-        Get relevant agents based on the query.
-        This method uses the vector database to search for similar agents based on the query.
-        The top 3 agents are selected and the LLM is asked to choose the most relevant agent.
-        This also returns the top documents from the search results and other agents that were not selected.
+        Build the agent selection prompt from the similarity search results.
+        The agents of the vector search are fused with the keyword index matches of the query by reciprocal rank fusion.
+        Returns the prompt and the candidate agents, best first.
         """
-        # We only run a similarity search on the latest query because the latest query is the most important and other queries were already
-        # used to determine if the current agent can answer the query or not.
-        results = self.vector_db.similarity_search_agents(query, k=3)
-        if results['ids'] == []:
-            top_documents_ids = []
-        else:
-            top_documents_ids = results["ids"]
-        top_documents = results["documents"]
-        if not top_documents:
+        vector_ranking = []
+        for metadata in (results["metadatas"] if results else []):
+            if metadata["agent_name"] not in vector_ranking:
+                vector_ranking.append(metadata["agent_name"])
+        keyword_ranking = []
+        if self.keyword_index is not None:
+            keyword_ranking = [
+                name for name, _ in self.keyword_index.search(query, k=3, allowed=self.usable_agents)
+            ]
+        agents_from_search = [
+            name for name in reciprocal_rank_fusion([vector_ranking, keyword_ranking]) if name in self.usable_agents
+        ][: self.max_candidates]
+        if not agents_from_search:
             # If no relevant agents are found, return the current agent or internet_search
-            self.add_system_message(
-                f"""
-                No relevant agents found. Proceed internet_search based on the query. Current agent is {self.current_agent.name}.
+            prompt = f"""
+                No relevant agents found. Proceed internet_search based on the query. Current agent is {session.current_agent.name}.
                 internet_search is usually preferred if no relevant agents are found but if the current agent has any capability to answer the question, then proceed with the current agent.
                 ONLY CHOSE BETWEEN THE CURRENT AGENT OR INTERNET_SEARCH. DO NOT CHOOSE ANY OTHER AGENT. 
                 """
-            )
-            self.add_human_message(query)
-            res = self.llm.invoke(self.conversation_history)
-            selected_agent = res["agent"]
-            res = {"relevant_agent": selected_agent, "other_agents": []}
-            self.set_current_agent(res["relevant_agent"])
-            res["top_documents"] = top_documents_ids
-            res["switched"] = True
-            res["query_used"] = query
-            self.remove_last_system_message()
-            self.remove_last_human_message()
-            return res
-        agents_from_search = set()
-        retrived_agents = set()
-        for metadata in results["metadatas"]:
-            retrived_agents.add(metadata["agent_name"])
-        for agent in self.agents:
-            if agent.name in retrived_agents:
-                agents_from_search.add(agent.name)
+            return prompt, []
         agents = self.db.get_agents(agents_from_search)
-        self.add_system_message(
-            f"""
+        prompt = f"""
             Determine the most relevant agent based on the conversation history. If the current agent is capable of answering the question, proceed with the current agent.
-            The specialized available agents are: {str(agents)}.
+            The specialized available agents are:
+            {self.catalog.render([agent.name for agent in agents])}
             If there are no relevant agents, then proceed with the current agent or internet_search. Choose wisely between the both. 
             ONLY GIVE IMPORTANCE TO THE NEWEST HUMAN MESSAGE. YOU CAN USE THE CONTEXT OF THE PREVIOUS MESSAGES TO DETERMINE THE RELEVANT AGENT BUT LATEST MESSAGE IS THE MOST IMPORTANT.
             ONLY CHOOSE FROM THESE AGENTS. DO NOT CHOOSE FROM ANY OTHER AGENT
             """
-        )
-        self.add_human_message(query)
-        res = self.llm.invoke(self.conversation_history)
-        selected_agent = res["agent"]
+        return prompt, agents
+
+    def _fast_path_agent(self, results, agents):
+        """
+        Return the top agent of the vector search if the routing can be decided without the LLM, otherwise None.
+        The closest agent has to be within fast_path_max_distance and the next different agent
+        has to be at least fast_path_min_margin further away. Without a different agent in the results there
+        is no known runner-up (e.g. all top chunks belong to one agent), so the LLM decides.
+        """
+        if self.fast_path_max_distance is None or not results or not results["distances"]:
+            return None
+        best_distances = {}
+        for metadata, distance in zip(results["metadatas"], results["distances"]):
+            agent_name = metadata["agent_name"]
+            if distance < best_distances.get(agent_name, float("inf")):
+                best_distances[agent_name] = distance
+        ranked = sorted(best_distances.items(), key=lambda item: item[1])
+        top_agent, top_distance = ranked[0]
+        if top_agent not in [agent.name for agent in agents]:
+            return None
+        if top_distance > self.fast_path_max_distance:
+            return None
+        if len(ranked) < 2 or ranked[1][1] - top_distance < self.fast_path_min_margin:
+            return None
+        return top_agent
+
+    async def _aselect_agent(self, session, query, prompt, agents, results):
+        """
+        Select the agent from the search results, returns the agent name and the routing path ("vector" or "llm")
+        """
+        selected_agent = self._fast_path_agent(results, agents)
+        if selected_agent is not None:
+            self.metrics["fast_path"] += 1
+            return selected_agent, "vector"
+        self.metrics["llm_selection"] += 1
+        res = await self._ainvoke(self.llm, session, "select", prompt, query)
+        return self._usable_agent_name(res["agent"], agents), "llm"
+
+    def _agent_selection_result(self, session, query, selected_agent, agents, results, routing_path="llm"):
         other_agents = [agent for agent in agents if agent.name != selected_agent]
         res = {"relevant_agent": selected_agent, "other_agents": other_agents}
-        self.set_current_agent(res["relevant_agent"])
-        res["top_documents"] = top_documents_ids
+        self.set_current_agent(session, res["relevant_agent"])
+        res["top_documents"] = results["ids"] if results else []
         res["switched"] = True
         res["query_used"] = query
-        self.remove_last_system_message()  # We do not require this message in the conversation history
-        self.remove_last_human_message()  # We do not require this message in the conversation history
+        res["routing_path"] = routing_path  # "vector" if the agent was picked from the search results alone
         return res
 
-    def get_relevant_agents_from_query(self, query):
+    def _candidates_event(self, agents, results):
+        return {
+            "agents": [agent.name for agent in agents],
+            "top_documents": results["ids"] if results else [],
+        }
+
+    def _add_turn(self, session, query, res):
         """
-        This method is the main method which is called from the API to get relevant agents based on the query.
-        The method first generates a better query or asks for clarification based on the user query.
-        If the better query is generated, it checks if the current agent can answer the query.
-        If the current agent cannot answer the query, it gets relevant agents based on the query.
+        Remember the query and the routing decision in the conversation history of the session, if remember_turns is on
         """
-        better_query = self.generate_better_query_or_ask_for_clarification(query)
-        if better_query == "$CLARIFY":
-            return {
-                "relevant_agent": None,
-                "other_agents": [],
-                "switched": False,
-                "clarify": True,
-            }
+        if not self.remember_turns:
+            return
+        if res.get("clarify"):
+            session.add_turn(query, "Asked the user to clarify the query.")
+        else:
+            session.add_turn(query, f"Routed the query to {res['relevant_agent']}.")
 
-        can_answer = self.check_if_current_agent_can_answer(better_query)
-        print("CAN ANSWER: ", can_answer)
-        if not can_answer:
-            agents = self.get_relevant_agents(better_query)
-            return agents
+    def _router_result(self, session, query):
+        """
+        Route the query with the tier-0 router, returns None if there is no router,
+        it is not confident enough or it predicts an agent which is not in the registry or not usable
+        """
+        if self.router is None:
+            return None
+        agent_name = self.router.route(query)
+        if agent_name is None or agent_name not in self.usable_agents:
+            return None
+        self.metrics["router_hits"] += 1
+        switched = agent_name != session.current_agent.name
+        self.set_current_agent(session, agent_name)
+        return {
+            "relevant_agent": agent_name,
+            "other_agents": [],
+            "top_documents": [],
+            "switched": switched,
+            "query_used": query,
+            "routing_path": "router",
+        }
+
+    def _routing_decision(self, res):
+        """
+        The part of a response which is stored in the routing cache. Everything that belongs to the request,
+        like the rewritten query and the documents it matched, is left out so it is never shown in another session.
+        """
+        return {
+            "relevant_agent": res["relevant_agent"],
+            "other_agents": res["other_agents"],
+            "switched": res["switched"],
+        }
+
+    def _use_routing_cache(self, session):
+        """
+        Whether the routing cache is looked up and filled for this turn. Only the first turn of a conversation uses it:
+        a follow-up like "what about the other one?" is resolved against the conversation history, so the decision
+        of a similar query in another conversation does not apply to it. Those turns bypass the cache.
+        """
+        if self.routing_cache is None:
+            return False
+        if session.get_conversation_history():
+            self.metrics["routing_cache_bypassed"] += 1
+            return False
+        return True
+
+    def _cached_result(self, session, query, cached):
+        """
+        Build the response from a cached routing decision and move the session to its agent
+        """
+        res = dict(cached)
+        self.set_current_agent(session, res["relevant_agent"])
+        res["top_documents"] = []
+        res["query_used"] = query
+        res["routing_path"] = "cache"
+        return res
+
+    def _fused_prompt(self, session, query, agents):
+        if agents:
+            candidates = f"""The candidate agents are:
+                {self.catalog.render([agent.name for agent in agents])}
+                ONLY CHOOSE FROM THE CANDIDATE AGENTS OR THE CURRENT AGENT."""
+        else:
+            candidates = """No relevant agents found. ONLY CHOOSE THE CURRENT AGENT."""
+        return f"""Route the user query to the right agent. Answer all of these in one response:
+                1. clarify: If the query is like "what is the internet" or "what is a computer", "Hello", "How are you", or it is not clear
+                and doesn't have enough context for a RAG model to answer, set clarify to true. Usually, if the query is a sensible sentence
+                and not jargon or has some sensible keywords, then it is okay to proceed with the query.
+                2. rewritten_query: Re-write the user query in a format which will perform better in the RAG model instead of answering the question.
+                3. current_agent_can_answer: Whether the current agent is capable of answering the query. Usually, if the current agent is a
+                specialized agent, then it is better to proceed with the current agent. BE STRICT, IT IS OKAY TO SWITCH IF IN DOUBT.
+                4. agent: The most relevant agent for the query. ONLY GIVE IMPORTANCE TO THE NEWEST HUMAN MESSAGE.
+                Usually, internet_search is not the answer and try to use more of the specialized agents which we have.
+                The current agent is {self.catalog.card(session.current_agent.name)}.
+                {candidates}
+                The user query is: {query}"""
+
+    def _fused_result(self, session, query, res, agents, results):
+        """
+        Build the response from the fused triage call, returns None if the answer is not usable
+        and the multi-call pipeline has to be used instead
+        """
+        if res.get("clarify"):
+            return self._clarify_result()
+        better_query = (res.get("rewritten_query") or "").strip()
+        if not better_query or better_query == "$CLARIFY":
+            return None
+        if res.get("current_agent_can_answer") and session.current_agent.name in self.usable_agents:
+            return self._current_agent_result(session, better_query)
+        if res.get("agent") not in self._fused_agent_names(session, agents):
+            return None
+        return self._agent_selection_result(session, better_query, res["agent"], agents, results)
+
+    def _fused_agent_names(self, session, agents):
+        """
+        The agents the fused triage can choose from: the pre-fetched candidates and the current agent, if usable
+        """
+        names = [agent.name for agent in agents] + [session.current_agent.name]
+        return [name for name in dict.fromkeys(names) if name in self.usable_agents]
+
+    def _fused_llm(self, agent_names):
+        """
+        Structured LLM of the fused triage whose agent enum only holds the given agents
+        """
+        schema = dict(self.fused_json_schema)
+        schema["properties"] = dict(schema["properties"], agent={"type": "string", "enum": agent_names})
+        return self.chat_model.with_structured_output(schema, method="json_schema")
+
+    def _clarify_result(self):
+        return {
+            "relevant_agent": None,
+            "other_agents": [],
+            "switched": False,
+            "clarify": True,
+            "routing_path": "llm",
+        }
+
+    def _current_agent_result(self, session, query):
         return {
-            "relevant_agent": self.current_agent.name,
+            "relevant_agent": session.current_agent.name,
             "other_agents": [],
             "switched": False,
-            "query_used": better_query,
+            "query_used": query,
+            "routing_path": "llm",
         }
+
+    def _rewrite_cache_key(self, session, query):
+        """
+        Key of a query rewrite in the rewrite cache, or None if the rewrite must not be cached.
+        The key changes with the model and the prompt, so a new model or prompt never gets old rewrites.
+        Only the first turn of a conversation is cached: later rewrites see the conversation history, which is
+        different in every session, so their entries would never be hit again. Those turns bypass the cache.
+        """
+        if self.rewrite_cache is None:
+            return None
+        if session.get_conversation_history():
+            self.metrics["rewrite_cache_bypassed"] += 1
+            return None
+        normalized_query = re.sub(r"\s+", " ", query).strip().lower().rstrip("?!. ")
+        key = json.dumps([self.model, self._clarification_prompt(""), normalized_query])
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    async def agenerate_better_query_or_ask_for_clarification(self, session, query):
+        """
+        Generate a better query or ask for clarification ($CLARIFY) based on the user query
+        """
+        key = self._rewrite_cache_key(session, query)
+        if key is not None:
+            cached = self.rewrite_cache.get(key)
+            if cached is not None:
+                return cached
+        res = await self._ainvoke(
+            self.clarification_llm, session, "rewrite", self._clarification_prompt(query), query
+        )
+        if key is not None:
+            self.rewrite_cache.put(key, res["text"])
+        return res["text"]
+
+    async def acheck_if_current_agent_can_answer(self, session, query) -> bool:
+        """
+        Check if the current agent can answer the query.
+        An agent which is not usable anymore (offline or private) never answers, without asking the LLM.
+        """
+        if session.current_agent.name not in self.usable_agents:
+            return False
+        res = await self._ainvoke(
+            self.llm, session, "can_answer", self._can_answer_prompt(session), query
+        )
+        return self._can_answer_from_response(session, res)
+
+    async def aroute_batch(self, queries, max_concurrency=8):
+        """
+        Route many stateless queries at once, e.g. for offline evaluation.
+        Every query starts from a fresh session, so there is no current agent to stay with and the
+        can-answer check is skipped. The tier-0 router is asked first and only the queries it is not confident
+        about go on: their rewrites run concurrently, then all rewritten queries are embedded and searched in
+        one multi-query vector search, then the agent selections run concurrently.
+        At most `max_concurrency` model calls run at the same time. Results are returned in input order.
+        """
+        self.refresh_agents()
+        semaphore = asyncio.Semaphore(max_concurrency)
+        sessions = [self.new_session(f"batch-{i}") for i in range(len(queries))]
+        responses = [self._router_result(session, query) for session, query in zip(sessions, queries)]
+        to_rewrite = [i for i, res in enumerate(responses) if res is None]
+
+        async def rewrite(session, query):
+            async with semaphore:
+                return await self.agenerate_better_query_or_ask_for_clarification(session, query)
+
+        better_queries = dict(zip(to_rewrite, await asyncio.gather(
+            *[rewrite(sessions[i], queries[i]) for i in to_rewrite]
+        )))
+        to_route = [i for i in to_rewrite if better_queries[i] != "$CLARIFY"]
+        search_results = await self.vector_db.asimilarity_search_agents_batch(
+            [better_queries[i] for i in to_route], k=3, where=self.agent_filter
+        )
+
+        async def select(i, results):
+            session, better_query = sessions[i], better_queries[i]
+            prompt, agents = self._agent_selection_prompt(session, better_query, results)
+            async with semaphore:
+                selected_agent, routing_path = await self._aselect_agent(
+                    session, better_query, prompt, agents, results
+                )
+            return self._agent_selection_result(
+                session, better_query, selected_agent, agents, results, routing_path
+            )
+
+        routed = await asyncio.gather(
+            *[select(i, results) for i, results in zip(to_route, search_results)]
+        )
+        for i in to_rewrite:
+            responses[i] = self._clarify_result()
+        for i, res in zip(to_route, routed):
+            responses[i] = res
+        return responses
+
+    async def astream_relevant_agents_from_query(self, session, query):
+        """
+        Triage the query and yield each stage as it finishes, see aget_relevant_agents_from_query.
+        Yields (event, data) tuples:
+            - "rewritten_query": the query rewritten for the RAG model (not sent when clarification is needed)
+            - "clarify": whether the user has to clarify the query
+            - "can_answer": whether the current agent can answer the query
+            - "candidates": the agents found by the vector search
+            - "result": the final response, the same as returned by aget_relevant_agents_from_query
+        In speculative and fused mode "candidates" can come first, "result" is always last.
+        When the tier-0 router is confident or the routing cache has the decision of a similar first-turn query,
+        only "result" is sent.
+        """
+        self.refresh_agents()
+        res = self._router_result(session, query)
+        if res is not None:
+            self._add_turn(session, query, res)
+            yield "result", res
+            return
+
+        partition = session.current_agent.name
+        query_vector = None
+        if self._use_routing_cache(session):
+            registry_version = self.routing_cache.registry_version
+            query_vector = (await self.vector_db.aembed_texts([query]))[0]
+            cached = self.routing_cache.lookup(query_vector, partition)
+            if cached is not None:
+                res = self._cached_result(session, query, cached)
+                self._add_turn(session, query, res)
+                yield "result", res
+                return
+
+        if self.fused:
+            pipeline = self._astream_fused
+        elif self.speculative:
+            pipeline = self._astream_speculative
+        else:
+            pipeline = self._astream_sequential
+        async for event, data in pipeline(session, query):
+            if event == "result":
+                if query_vector is not None and not data.get("clarify"):
+                    self.routing_cache.add(query_vector, partition, self._routing_decision(data), registry_version)
+                self._add_turn(session, query, data)
+            yield event, data
+
+    async def _astream_sequential(self, session, query):
+        """
+        Triage pipeline which runs the stages one after another, see astream_relevant_agents_from_query
+        """
+        better_query = await self.agenerate_better_query_or_ask_for_clarification(
+            session, query
+        )
+        clarify = better_query == "$CLARIFY"
+        if not clarify:
+            yield "rewritten_query", {"query": better_query}
+        yield "clarify", {"clarify": clarify}
+        if clarify:
+            yield "result", self._clarify_result()
+            return
+
+        can_answer = await self.acheck_if_current_agent_can_answer(session, better_query)
+        print("CAN ANSWER: ", can_answer)
+        yield "can_answer", {"can_answer": can_answer}
+        if can_answer:
+            yield "result", self._current_agent_result(session, better_query)
+            return
+
+        results = await self.vector_db.asimilarity_search_agents(better_query, k=3, where=self.agent_filter)
+        prompt, agents = self._agent_selection_prompt(session, better_query, results)
+        yield "candidates", self._candidates_event(agents, results)
+        selected_agent, routing_path = await self._aselect_agent(
+            session, better_query, prompt, agents, results
+        )
+        yield "result", self._agent_selection_result(
+            session, better_query, selected_agent, agents, results, routing_path
+        )
+
+    async def _astream_fused(self, session, query):
+        """
+        Triage the query with a single model call over the candidates of a vector search on the raw query.
+        Falls back to the sequential pipeline if the call failed or its answer cannot be used, also
+        without a usable agent to choose from, as the enum of the answer would be empty.
+        """
+        results = await self.vector_db.asimilarity_search_agents(query, k=3, where=self.agent_filter)
+        _, agents = self._agent_selection_prompt(session, query, results)
+        yield "candidates", self._candidates_event(agents, results)
+        agent_names = self._fused_agent_names(session, agents)
+        fused_result = None
+        if agent_names:
+            self.metrics["fused_calls"] += 1
+            try:
+                res = await self._ainvoke(
+                    self._fused_llm(agent_names), session, "fused", self._fused_prompt(session, query, agents), query
+                )
+                fused_result = self._fused_result(session, query, res, agents, results)
+            except Exception as e:
+                print("Fused triage error:", e)
+        if fused_result is None:
+            self.metrics["fused_fallbacks"] += 1
+            async for event in self._astream_sequential(session, query):
+                yield event
+            return
+
+        clarify = bool(fused_result.get("clarify"))
+        if not clarify:
+            yield "rewritten_query", {"query": fused_result["query_used"]}
+        yield "clarify", {"clarify": clarify}
+        if not clarify:
+            yield "can_answer", {"can_answer": not fused_result["switched"]}
+        yield "result", fused_result
+
+    async def _astream_speculative(self, session, query):
+        """
+        Speculative version of the triage pipeline.
+        The vector search on the raw query runs while the query is being rewritten, and the agent selection
+        runs at the same time as the can-answer check. Branches which turn out not to be needed are cancelled
+        and counted in the "speculative_wasted" metric.
+        """
+        tasks = []
+        try:
+            search_task = asyncio.create_task(
+                self.vector_db.asimilarity_search_agents(query, k=3, where=self.agent_filter)
+            )
+            tasks.append(search_task)
+            self.metrics["speculative_calls"] += 1
+
+            better_query = await self.agenerate_better_query_or_ask_for_clarification(
+                session, query
+            )
+            clarify = better_query == "$CLARIFY"
+            if not clarify:
+                yield "rewritten_query", {"query": better_query}
+            yield "clarify", {"clarify": clarify}
+            if clarify:
+                self.metrics["speculative_wasted"] += 1
+                yield "result", self._clarify_result()
+                return
+
+            can_answer_task = asyncio.create_task(
+                self.acheck_if_current_agent_can_answer(session, better_query)
+            )
+            tasks.append(can_answer_task)
+            results = await search_task
+            prompt, agents = self._agent_selection_prompt(session, better_query, results)
+            yield "candidates", self._candidates_event(agents, results)
+            # The agent selection only needs the LLM if the search results are not conclusive
+            fast_path_agent = self._fast_path_agent(results, agents)
+            select_task = None
+            if fast_path_agent is None:
+                select_task = asyncio.create_task(
+                    self._ainvoke(self.llm, session, "select", prompt, better_query)
+                )
+                tasks.append(select_task)
+                self.metrics["speculative_calls"] += 1
+
+            can_answer = await can_answer_task
+            print("CAN ANSWER: ", can_answer)
+            yield "can_answer", {"can_answer": can_answer}
+            if can_answer:
+                # Neither the search nor the agent selection was needed
+                self.metrics["speculative_wasted"] += 1 if select_task is None else 2
+                yield "result", self._current_agent_result(session, better_query)
+                return
+            if select_task is None:
+                self.metrics["fast_path"] += 1
+                selected_agent, routing_path = fast_path_agent, "vector"
+            else:
+                self.metrics["llm_selection"] += 1
+                selected_agent = self._usable_agent_name((await select_task)["agent"], agents)
+                routing_path = "llm"
+            yield "result", self._agent_selection_result(
+                session, better_query, selected_agent, agents, results, routing_path
+            )
+        finally:
+            # Cancel the branches which are not needed anymore, also when the client went away
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    async def aget_relevant_agents_from_query(self, session, query):
+        """
+        This method is the main method which is called from the API to get relevant agents based on the query.
+        The method first generates a better query or asks for clarification based on the user query.
+        If the better query is generated, it checks if the current agent can answer the query.
+        If the current agent cannot answer the query, it gets relevant agents based on the query.
+        All model calls use `ainvoke` so a single worker can wait on many requests at the same time.
+        """
+        async for event, data in self.astream_relevant_agents_from_query(session, query):
+            if event == "result":
+                return data
+
+    def get_relevant_agents_from_query(self, session, query):
+        """
+        Blocking wrapper of aget_relevant_agents_from_query for scripts, must not be called from an event loop.
+        There is only one triage pipeline, the async one.
+        """
+        return asyncio.run(self.aget_relevant_agents_from_query(session, query))
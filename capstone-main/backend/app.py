@@ -1,11 +1,21 @@
-from typing import Union
-from fastapi import FastAPI
+from typing import Union, Optional, List
+from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Depends
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
 import os
+import json
+import asyncio
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 from fastapi.middleware import Middleware
 from starlette.middleware.cors import CORSMiddleware
 
 from agent.triage import TriageAgent
+from agent.session import SessionStore
+from agent.cache import LRUCache
+from agent.routing_cache import SemanticRoutingCache
+from documents.ingestion import IngestionQueue, QueueFullError
 from documents.metadata import MetadataExtractor
 load_dotenv()
 
@@ -16,9 +26,87 @@ load_dotenv()
 # hardcoding them here.
 os.environ['OPENAI_BASE_URL'] = os.getenv('OPENAI_BASE_URL', "http://host.docker.internal:1234/v1")
 os.environ['OPENAI_API_KEY'] = os.getenv('OPENAI_API_KEY', "test")
+
+def create_numpy_vector_store():
+    from database.numpy_store import NumpyVectorStore
+
+    quantization = os.getenv('NUMPY_STORE_QUANTIZATION', "int8")
+    return NumpyVectorStore(
+        os.getenv('NUMPY_STORE_PATH', "database/numpy_store"),
+        quantization=None if quantization == "none" else quantization,
+        rescore_factor=int(os.getenv('NUMPY_STORE_RESCORE_FACTOR', "4")),
+        # NUMPY_STORE_INDEX=ivf searches only the NUMPY_STORE_NPROBE closest clusters of large collections
+        index=os.getenv('NUMPY_STORE_INDEX', "flat"),
+        nprobe=int(os.getenv('NUMPY_STORE_NPROBE', "8")),
+        ivf_min_vectors=int(os.getenv('NUMPY_STORE_IVF_MIN_VECTORS', "10000")),
+    )
+
+
+# The triage agent is shared by all sessions. Creating it is cheap, the LLM clients, databases
+# and agent registry are loaded by the warmup task so the server starts accepting connections right away.
+triage_agent = TriageAgent(
+    speculative=os.getenv('TRIAGE_SPECULATIVE', "false").lower() == "true",
+    fused=os.getenv('TRIAGE_FUSED', "false").lower() == "true",
+    router_dir=os.getenv('ROUTER_DIR', "database/router"),
+    keywords_path=os.getenv('AGENT_KEYWORDS_PATH', "database/agent_keywords.json"),
+    use_agent_index=os.getenv('AGENT_INDEX', "true").lower() == "true",
+    # VECTOR_STORE=numpy uses the NumPy store with quantized, memory-mapped vectors instead of Chroma
+    vector_store_factory=create_numpy_vector_store if os.getenv('VECTOR_STORE', "chroma") == "numpy" else None,
+    # Only online, public agents are routed to, TRIAGE_AGENT_TYPES (e.g. "internet,organizational") also limits the agent types
+    agent_filter={
+        "online": True,
+        "is_public": True,
+        **({"agent_type": os.getenv('TRIAGE_AGENT_TYPES').split(",")} if os.getenv('TRIAGE_AGENT_TYPES') else {}),
+    },
+    fast_path_max_distance=float(os.getenv('TRIAGE_FAST_PATH_MAX_DISTANCE', "0.8")),
+    fast_path_min_margin=float(os.getenv('TRIAGE_FAST_PATH_MIN_MARGIN', "0.2")),
+    # Set REWRITE_CACHE_DB_PATH (e.g. database/rewrite_cache.db) to keep the cached rewrites across restarts
+    rewrite_cache=LRUCache(
+        max_size=int(os.getenv('REWRITE_CACHE_SIZE', "10000")),
+        ttl_seconds=float(os.getenv('REWRITE_CACHE_TTL_SECONDS', "86400")),
+        db_path=os.getenv('REWRITE_CACHE_DB_PATH'),
+        table="query_rewrites",
+        max_persistent_size=int(os.getenv('REWRITE_CACHE_PERSISTENT_SIZE', "100000")),
+    ),
+    # Set REMEMBER_TURNS=true to send the past turns of a session (at most HISTORY_MAX_TOKENS) with every model call
+    remember_turns=os.getenv('REMEMBER_TURNS', "false").lower() == "true",
+    history_max_tokens=int(os.getenv('HISTORY_MAX_TOKENS', "1500")),
+    routing_cache=SemanticRoutingCache(
+        max_size=int(os.getenv('ROUTING_CACHE_SIZE', "5000")),
+        similarity_threshold=float(os.getenv('ROUTING_CACHE_SIMILARITY', "0.95")),
+        ttl_seconds=float(os.getenv('ROUTING_CACHE_TTL_SECONDS', "3600")),
+    ),
+)
+warmup_state = {"ready": False, "error": None}
+
+
+def warmup():
+    try:
+        triage_agent.load_agent()
+        warmup_state["ready"] = True
+        print("Triage agent loaded, ready to serve requests.")
+    except Exception as e:
+        print("Error loading the triage agent:", e)
+        warmup_state["error"] = str(e)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Keep a reference to the task so it is not garbage collected while running
+    app.state.warmup_task = asyncio.create_task(asyncio.to_thread(warmup))
+    yield
+
+
+def require_ready():
+    if not warmup_state["ready"]:
+        raise HTTPException(status_code=503, detail="Triage agent is still loading.", headers={"Retry-After": "1"})
+
+
 app = FastAPI(
+    lifespan=lifespan,
     middleware=[
-         Middleware(CORSMiddleware, allow_origins=["*"])
+         # The preflight of the session, metadata and agent status endpoints needs their methods listed
+         Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["GET", "POST", "PUT", "DELETE"])
     ]
 )
 
@@ -27,43 +115,87 @@ def read_root():
     return {"Hello": "World"}
 
 
+# Readiness probe, only returns 200 once the agent registry and the vector index are loaded
+@app.get("/ready")
+def read_ready():
+    if not warmup_state["ready"]:
+        raise HTTPException(status_code=503, detail={"ready": False, "error": warmup_state["error"]})
+    return {"ready": True}
+
+
+# Background workers which extract and save metadata, they share one MetadataExtractor
+ingestion_queue = IngestionQueue(
+    num_workers=int(os.getenv('INGESTION_WORKERS', "2")),
+    max_queue_size=int(os.getenv('INGESTION_QUEUE_SIZE', "100")),
+    # The extractor writes through the triage agent's vector store, which keeps the agent index up to date
+    extractor_factory=lambda: MetadataExtractor(vector_store=triage_agent.vector_db),
+    # New agent metadata can change routing decisions, so the cached ones are dropped
+    on_success=lambda job: triage_agent.routing_cache.invalidate(),
+)
+
 # API Call to get text from user and extract metadata to save it for a specific agent name
-@app.post("/metadata")
-def extract_metadata(agent_name: str, text: str):
+@app.post("/metadata", status_code=202, dependencies=[Depends(require_ready)])
+def extract_metadata(agent_name: str, text: str, replace: bool = False):
     """
-    Extracts metadata from the provided text and saves it using the specified agent name.
+    Queues the extraction of metadata from the provided text, the metadata is saved using the specified agent name.
+    Metadata which is identical to the metadata already stored for the agent is not added again.
 
     Args:
         agent_name (str): The name of the agent performing the metadata extraction.
         text (str): The text from which metadata needs to be extracted.
+        replace (bool): Replace all the previous metadata of the agent instead of adding to it.
 
     Returns:
-        dict: A dictionary containing the status of the operation.
-            Example: {"status": "success"}
+        dict: A dictionary containing the status of the operation and the id of the ingestion job.
+            Example: {"status": "queued", "job_id": "..."}
+
+    Raises:
+        HTTPException: 503 with a Retry-After header if the ingestion queue is full.
 
     Comments for frontend:
         - Endpoint: POST /metadata
-        - Request Body: JSON object with 'agent_name' and 'text' fields.
-        - Response: JSON object with a 'status' field indicating the success of the operation.
+        - Request Body: JSON object with 'agent_name', 'text' and optional 'replace' fields.
+        - Response: JSON object with a 'status' field and a 'job_id' to poll GET /metadata/jobs/{job_id}.
     """
-    metadata_extractor = MetadataExtractor()
+    try:
+        job = ingestion_queue.submit(agent_name, text, replace=replace)
+    except QueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+    return {"status": job.status, "job_id": job.job_id}
 
-    metadata_extractor.extract_and_save_metadata_from_text(text, agent_name)
-    return {"status": "success"}
 
+# API Call to get the status and result of a metadata ingestion job
+@app.get("/metadata/jobs/{job_id}")
+def get_metadata_job(job_id: str):
+    """
+    Returns the status of an ingestion job.
 
-# Load the triage agent
-triage_agent = TriageAgent()
-triage_agent.load_agent()
+    Comments for frontend:
+        - Endpoint: GET /metadata/jobs/{job_id}
+        - Response: JSON object with 'status' ("queued", "running", "succeeded" or "failed"),
+          'result' with the extracted metadata and 'error' if the job failed.
+    """
+    job = ingestion_queue.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found.")
+    return job.to_dict()
+
+
+# Per-session conversation state, sessions unused for SESSION_TTL_SECONDS or beyond SESSION_MAX_COUNT are evicted
+session_store = SessionStore(
+    max_sessions=int(os.getenv('SESSION_MAX_COUNT', "10000")),
+    ttl_seconds=float(os.getenv('SESSION_TTL_SECONDS', "3600")),
+)
 
 # API call to get user query and return agents similar to the query
-@app.get("/agents")
-def get_similar_agents(query: str):
+@app.get("/agents", dependencies=[Depends(require_ready)])
+async def get_similar_agents(query: str, session_id: Optional[str] = None):
     """
     Endpoint to retrieve similar agents based on a query string.
 
     Args:
         query (str): The query string to search for similar agents.
+        session_id (str, optional): The id of the conversation. A new session is started if it is not provided or unknown.
 
     Returns:
         list: A list of agents relevant to the provided query.
@@ -72,9 +204,141 @@ def get_similar_agents(query: str):
     
     Comments for frontend:
         - Endpoint: GET /agents
-        - Request Parameters: query
-        - Response: JSON object with a list of relevant agents
+        - Request Parameters: query, session_id
+        - Response: JSON object with a list of relevant agents and the 'session_id' to send with the next query
+    """
+    session = session_store.get_or_create(session_id, triage_agent.new_session)
+    async with session.lock:
+        res = await triage_agent.aget_relevant_agents_from_query(session, query)
+        res['conversation_history'] = session.get_generated_conversation_log()
+    res['session_id'] = session.session_id
+    return res
+
+
+# API call to get user query and stream each triage stage as server-sent events
+@app.get("/agents/stream", dependencies=[Depends(require_ready)])
+async def stream_similar_agents(query: str, session_id: Optional[str] = None):
+    """
+    Streaming variant of GET /agents which sends each triage stage as soon as it finishes.
+
+    Args:
+        query (str): The query string to search for similar agents.
+        session_id (str, optional): The id of the conversation. A new session is started if it is not provided or unknown.
+
+    Returns:
+        StreamingResponse: A `text/event-stream` response.
+
+    Comments for frontend:
+        - Endpoint: GET /agents/stream
+        - Request Parameters: query, session_id
+        - Events: 'rewritten_query', 'clarify', 'can_answer', 'candidates' and finally 'result',
+          which has the same JSON body as GET /agents
+        - If a stage fails an 'error' event with a 'detail' is sent instead of 'result' and the stream ends,
+          a stream which ends without 'result' or 'error' was cut off
+    """
+    session = session_store.get_or_create(session_id, triage_agent.new_session)
+
+    async def event_stream():
+        async with session.lock:
+            try:
+                async for event, data in triage_agent.astream_relevant_agents_from_query(session, query):
+                    if event == "result":
+                        data['conversation_history'] = session.get_generated_conversation_log()
+                        data['session_id'] = session.session_id
+                    yield f"event: {event}\ndata: {json.dumps(jsonable_encoder(data))}\n\n"
+            except Exception as e:
+                print("Triage stream error:", e)
+                error = {"detail": "The triage failed.", "session_id": session.session_id}
+                yield f"event: error\ndata: {json.dumps(error)}\n\n"
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+
+class BatchTriageRequest(BaseModel):
+    queries: List[str]  # The queries to route, each one is routed on its own without a conversation
+
+
+# API call to route many queries in one request
+@app.post("/agents/batch", dependencies=[Depends(require_ready)])
+async def get_similar_agents_batch(request: BatchTriageRequest):
+    """
+    Endpoint to route many stateless queries at once, e.g. for offline evaluation or pre-routing jobs.
+
+    Args:
+        request (BatchTriageRequest): JSON body with the list of 'queries'.
+
+    Returns:
+        dict: A dictionary with the 'results' of the queries in input order, each one like the response of GET /agents.
+
+    Raises:
+        HTTPException: 413 if there are more than BATCH_MAX_QUERIES queries.
+
+    Comments for frontend:
+        - Endpoint: POST /agents/batch
+        - Request Body: JSON object with a 'queries' list.
+        - Response: JSON object with a 'results' list.
+    """
+    max_queries = int(os.getenv('BATCH_MAX_QUERIES', "1000"))
+    if len(request.queries) > max_queries:
+        raise HTTPException(status_code=413, detail=f"At most {max_queries} queries per batch.")
+    results = await triage_agent.aroute_batch(
+        request.queries,
+        max_concurrency=int(os.getenv('BATCH_MAX_CONCURRENCY', "8")),
+    )
+    return {"results": results}
+
+
+# API call to change the availability of an agent
+@app.put("/agents/{agent_name}/status", dependencies=[Depends(require_ready)])
+def update_agent_status(agent_name: str, online: Optional[bool] = None, is_public: Optional[bool] = None):
+    """
+    Endpoint to take an agent offline or online, or to make it public or private.
+    Agents which are offline or private are filtered out of the agent search right away.
+
+    Args:
+        agent_name (str): The name of the agent.
+        online (bool, optional): The new online flag.
+        is_public (bool, optional): The new is_public flag.
+
+    Raises:
+        HTTPException: 404 if there is no agent with this name.
+
+    Comments for frontend:
+        - Endpoint: PUT /agents/{agent_name}/status
+        - Request Parameters: online, is_public
+        - Response: JSON object with the 'agent_name' and its 'usable' flag.
+    """
+    if not triage_agent.update_agent_status(agent_name, online=online, is_public=is_public):
+        raise HTTPException(status_code=404, detail=f"Agent {agent_name} not found.")
+    return {"agent_name": agent_name, "usable": agent_name in triage_agent.usable_agents}
+
+
+# API call to get the counters of the triage pipeline
+@app.get("/metrics")
+def get_metrics():
+    """
+    Returns the triage counters, e.g. how many speculative calls were wasted or the rewrite cache hits and misses.
+
+    Comments for frontend:
+        - Endpoint: GET /metrics
+        - Response: JSON object of counter names to values.
+    """
+    metrics = dict(triage_agent.metrics)
+    for name, value in triage_agent.rewrite_cache.stats().items():
+        metrics[f"rewrite_cache_{name}"] = value
+    for name, value in triage_agent.routing_cache.stats().items():
+        metrics[f"routing_cache_{name}"] = value
+    return metrics
+
+
+# API call to end a conversation and free its state
+@app.delete("/sessions/{session_id}")
+async def delete_session(session_id: str):
+    """
+    Endpoint to delete the state of a conversation.
+
+    Comments for frontend:
+        - Endpoint: DELETE /sessions/{session_id}
+        - Response: JSON object with a 'deleted' field indicating if the session existed.
     """
-    res = triage_agent.get_relevant_agents_from_query(query)
-    res['conversation_history'] = [msg.content for msg in triage_agent.get_generated_conversation_log()]
-    return res
\ No newline at end of file
+    return {"deleted": session_store.delete(session_id)}
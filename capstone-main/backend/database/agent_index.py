@@ -0,0 +1,199 @@
+import threading
+import numpy as np
+
+FILTER_ATTRIBUTES = ("online", "is_public", "agent_type")
+
+
+def matches_filter(attributes: dict, where: dict) -> bool:
+    '''
+    Whether attributes match a filter of attribute names to a value or a list of allowed values.
+    '''
+    for key, expected in where.items():
+        value = attributes.get(key)
+        if isinstance(expected, (list, tuple, set)):
+            if value not in expected:
+                return False
+        elif value != expected:
+            return False
+    return True
+
+
+class AgentCentroidIndex:
+    '''
+    In-memory index with one vector per agent: the normalized mean of all the agent's metadata embeddings.
+    The vectors are rows of a contiguous float32 matrix, so a search is a single matrix product followed
+    by an argpartition top-k, and every result is a different agent. Adding metadata updates the
+    agent's running sum, so the index never has to be rebuilt from the store.
+    Distances are squared L2 distances of normalized vectors (2 - 2 * cosine), the same scale as the
+    default Chroma distance of normalized embeddings.
+    Each agent also has filter attributes (online, is_public, agent_type). A search with a `where` filter
+    masks out the other agents before the top-k, the mask of each filter is cached until an agent changes.
+    The stored ids, texts and vectors of each agent are kept as well, so a result can point to the agent's
+    chunk which matches the query best.
+    '''
+
+    def __init__(self, dim: int = None, capacity: int = 64):
+        self.lock = threading.Lock()
+        self.names = []  # Row -> agent name
+        self.rows = {}  # Agent name -> row
+        self.chunks = []  # Row -> list of (id, text) of the agent's stored metadata
+        self.chunk_vectors = []  # Row -> (chunks, dim) float32 normalized embeddings of the agent's metadata
+        self.attributes = []  # Row -> filter attributes of the agent
+        self.masks = {}  # Filter -> boolean mask of the rows which match it
+        self.dim = dim
+        self.capacity = capacity
+        self.sums = None  # (capacity, dim) float64 sums of the agent embeddings
+        self.counts = np.zeros(capacity, dtype=np.int64)
+        self.matrix = None  # (capacity, dim) float32 normalized centroids, only the first len(names) rows are used
+
+    @classmethod
+    def from_collection(cls, collection):
+        """
+        Build the index from a Chroma collection whose metadatas have an 'agent_name'
+        """
+        data = collection.get(include=["embeddings", "metadatas", "documents"])
+        index = cls()
+        for id, embedding, metadata, document in zip(
+            data["ids"], data["embeddings"], data["metadatas"], data["documents"]
+        ):
+            attributes = {key: metadata[key] for key in FILTER_ATTRIBUTES if key in metadata}
+            index.add(metadata["agent_name"], [id], [embedding], [document], attributes)
+        return index
+
+    def add(self, agent_name, ids, embeddings, documents=None, attributes=None):
+        """
+        Add the stored ids, embeddings and texts of an agent's metadata and update its centroid and filter attributes
+        """
+        vectors = np.asarray(embeddings, dtype=np.float64)
+        if vectors.ndim == 1:
+            vectors = vectors[None, :]
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms > 0, norms, 1)
+        with self.lock:
+            if self.sums is None:
+                self.dim = vectors.shape[1]
+                self.sums = np.zeros((self.capacity, self.dim), dtype=np.float64)
+                self.matrix = np.zeros((self.capacity, self.dim), dtype=np.float32)
+            row = self.rows.get(agent_name)
+            if row is None:
+                row = len(self.names)
+                if row == self.capacity:
+                    self._grow()
+                self.rows[agent_name] = row
+                self.names.append(agent_name)
+                self.chunks.append([])
+                self.chunk_vectors.append(np.zeros((0, self.dim), dtype=np.float32))
+                self.attributes.append({})
+            self.chunks[row].extend(zip(ids, documents or [""] * len(ids)))
+            self.chunk_vectors[row] = np.vstack([self.chunk_vectors[row], vectors.astype(np.float32)])
+            if attributes:
+                self.attributes[row] = {**self.attributes[row], **attributes}
+            self.masks.clear()
+            self.sums[row] += vectors.sum(axis=0)
+            self.counts[row] += len(vectors)
+            centroid = self.sums[row] / self.counts[row]
+            norm = np.linalg.norm(centroid)
+            self.matrix[row] = centroid / norm if norm > 0 else centroid
+
+    def remove(self, agent_name):
+        """
+        Remove an agent from the index, e.g. before re-adding its replaced metadata
+        """
+        with self.lock:
+            row = self.rows.pop(agent_name, None)
+            if row is None:
+                return
+            last = len(self.names) - 1
+            if row != last:
+                # Move the last agent into the freed row to keep the used rows contiguous
+                moved = self.names[last]
+                self.names[row] = moved
+                self.chunks[row] = self.chunks[last]
+                self.chunk_vectors[row] = self.chunk_vectors[last]
+                self.attributes[row] = self.attributes[last]
+                self.sums[row] = self.sums[last]
+                self.counts[row] = self.counts[last]
+                self.matrix[row] = self.matrix[last]
+                self.rows[moved] = row
+            self.names.pop()
+            self.chunks.pop()
+            self.chunk_vectors.pop()
+            self.attributes.pop()
+            self.masks.clear()
+            self.sums[last] = 0
+            self.counts[last] = 0
+            self.matrix[last] = 0
+
+    def set_attributes(self, agent_name, attributes):
+        """
+        Update the filter attributes of an agent, e.g. when it goes offline
+        """
+        with self.lock:
+            row = self.rows.get(agent_name)
+            if row is not None:
+                self.attributes[row] = {**self.attributes[row], **attributes}
+                self.masks.clear()
+
+    def search(self, query_vectors, k: int = 5, where=None) -> list:
+        """
+        Returns for each query vector up to k (agent name, distance) pairs of distinct agents, closest first.
+        With `where` only the agents whose attributes match the filter are returned.
+        """
+        queries = np.asarray(query_vectors, dtype=np.float32)
+        if queries.ndim == 1:
+            queries = queries[None, :]
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        with self.lock:
+            n = len(self.names)
+            if n == 0:
+                return [[] for _ in range(len(queries))]
+            scores = queries @ self.matrix[:n].T
+            names = list(self.names)
+            if where:
+                mask = self._mask(where, n)
+                scores[:, ~mask] = -np.inf
+                n = int(mask.sum())
+        k = min(k, n)
+        if k == 0:
+            return [[] for _ in range(len(queries))]
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        results = []
+        for row_scores, row_top in zip(scores, top):
+            ordered = row_top[np.argsort(-row_scores[row_top])]
+            results.append([(names[i], float(2 - 2 * row_scores[i])) for i in ordered])
+        return results
+
+    def _mask(self, where, n):
+        key = tuple(sorted(
+            (name, tuple(value) if isinstance(value, (list, tuple, set)) else value) for name, value in where.items()
+        ))
+        mask = self.masks.get(key)
+        if mask is None:
+            mask = np.array([matches_filter(attributes, where) for attributes in self.attributes[:n]], dtype=bool)
+            self.masks[key] = mask
+        return mask
+
+    def best_chunk(self, agent_name, query_vector):
+        """
+        The (id, text) of the agent's stored metadata closest to the query vector, or (None, "") for an unknown agent
+        """
+        with self.lock:
+            row = self.rows.get(agent_name)
+            if row is None or not self.chunks[row]:
+                return None, ""
+            scores = self.chunk_vectors[row] @ np.asarray(query_vector, dtype=np.float32)
+            return self.chunks[row][int(np.argmax(scores))]
+
+    def _grow(self):
+        self.capacity *= 2
+        sums = np.zeros((self.capacity, self.dim), dtype=np.float64)
+        matrix = np.zeros((self.capacity, self.dim), dtype=np.float32)
+        counts = np.zeros(self.capacity, dtype=np.int64)
+        used = len(self.names)
+        sums[:used] = self.sums[:used]
+        matrix[:used] = self.matrix[:used]
+        counts[:used] = self.counts[:used]
+        self.sums, self.matrix, self.counts = sums, matrix, counts
+
+    def __len__(self):
+        return len(self.names)
@@ -1,19 +1,35 @@
 import sqlite3
+import threading
 from typing import Optional
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 
 class AgentData(BaseModel):
     '''
     Class to represent the agent data and capabilities.
+    Instances are immutable because the registry cache shares them between requests.
     '''
+    model_config = ConfigDict(frozen=True)
+
     name: str
     capability: Optional[str] = "" # Think of agent capabilities as the skills or expertise of the agent or a brief description of what the agent can do.
     description: Optional[str] = "" # A brief description of the agent.
     specialization_keywords: Optional[list[str]] = [] # Keywords that describe the agent's specializations.
+    is_public: bool = True # Whether the agent can be used by everyone.
+    online: bool = True # Whether the agent is currently available.
+    agent_type: Optional[str] = None # The type of the agent, e.g. "internet" or "organizational".
     
     def __str__(self):
         return f"AgentData(name={self.name}, capability={self.capability}, description={self.description}, specialization_keywords={self.specialization_keywords})"
     
+    def filter_attributes(self) -> dict:
+        """
+        The attributes of the agent which the agent searches can filter on
+        """
+        attributes = {"is_public": self.is_public, "online": self.online}
+        if self.agent_type is not None:
+            attributes["agent_type"] = self.agent_type
+        return attributes
+
     def to_dict(self):
         return {
             "name": self.name,
@@ -22,35 +38,95 @@ class AgentData(BaseModel):
             "specialization_keywords": self.specialization_keywords
         }
 
+AGENT_COLUMNS = "name, capability, description, specialization_keywords, is_public, online, agent_type"
+
+
+def agent_from_row(row) -> AgentData:
+    return AgentData(
+        name=row[0], capability=row[1], description=row[2], specialization_keywords=row[3],
+        is_public=bool(row[4]), online=bool(row[5]), agent_type=row[6],
+    )
+
+
 class SQLLiteDatabase():
+    '''
+    Agent registry backed by SQLite.
+    All agents are loaded once into a name-keyed dict of immutable AgentData records and lookups are answered
+    from memory. The dict is reloaded only when `PRAGMA data_version` shows that another connection changed
+    the database; writes made through this connection drop it explicitly, as they do not change data_version.
+    '''
     
     def __init__(self, db_path: str):
         self.db_path = db_path
         self.connection = sqlite3.connect(db_path, check_same_thread=False)
         self.cursor = self.connection.cursor()
+        self.lock = threading.Lock()  # The connection is shared by the request threads
+        self.registry = None  # Agent name -> AgentData, in table order, loaded on first use
+        self.data_version = None  # PRAGMA data_version when the registry was loaded
+        self.registry_version = 0  # Increased every time the registry is reloaded or extended
     
+    def _get_registry(self) -> dict:
+        # The cached registry, reloaded if the database was changed by another connection
+        with self.lock:
+            data_version = self.connection.execute("PRAGMA data_version").fetchone()[0]
+            if self.registry is None or data_version != self.data_version:
+                registry = {}
+                for row in self.connection.execute(f"SELECT {AGENT_COLUMNS} FROM ai_agent"):
+                    registry.setdefault(row[0], agent_from_row(row))
+                self.registry = registry
+                self.data_version = data_version
+                self.registry_version += 1
+            return self.registry
+
+    def get_registry_version(self) -> int:
+        '''
+        Version of the cached registry, it changes every time the agents were changed, by this or another connection
+        '''
+        self._get_registry()
+        return self.registry_version
     
     def get_all_agents(self) -> list[AgentData]:
         '''
         Get all agents from the database
         '''
-        self.cursor.execute("SELECT name, capability, description, specialization_keywords FROM ai_agent")
-        data = self.cursor.fetchall()
-        agents = []
-        for row in data:
-            agent = AgentData(name=row[0], capability=row[1], description=row[2], specialization_keywords=row[3])
-            agents.append(agent)
-        return agents
+        return list(self._get_registry().values())
         
     def get_agents(self, agent_names : set) -> list[AgentData]:
         '''
-        Get agents from the database based on the agent names
+        Get agents from the database based on the agent names, in the order of the names.
+        Names which are not in the cached registry are looked up with a single query.
+        '''
+        registry = self._get_registry()
+        missing = [name for name in dict.fromkeys(agent_names) if name not in registry]
+        if missing:
+            placeholders = ",".join("?" * len(missing))
+            with self.lock:
+                rows = self.connection.execute(
+                    f"SELECT {AGENT_COLUMNS} FROM ai_agent WHERE name IN ({placeholders})", missing
+                ).fetchall()
+                if rows:
+                    # Copy on write, other threads may be reading the current registry
+                    registry = dict(self.registry or registry)
+                    for row in rows:
+                        registry.setdefault(row[0], agent_from_row(row))
+                    self.registry = registry
+                    self.registry_version += 1
+        return [registry[name] for name in agent_names if name in registry]
+
+    def set_agent_status(self, agent_name: str, online: Optional[bool] = None, is_public: Optional[bool] = None) -> bool:
+        '''
+        Update the online and/or is_public flags of an agent, returns False if there is no such agent
         '''
-        agents = []
-        for name in agent_names:
-            self.cursor.execute("SELECT name, capability, description, specialization_keywords FROM ai_agent WHERE name=?", (name,))
-            data = self.cursor.fetchone()
-            if data:
-                agent = AgentData(name=data[0], capability=data[1], description=data[2], specialization_keywords=data[3])
-                agents.append(agent)
-        return agents
\ No newline at end of file
+        updates = {"online": online, "is_public": is_public}
+        updates = {column: int(value) for column, value in updates.items() if value is not None}
+        if not updates:
+            return agent_name in self._get_registry()
+        assignments = ", ".join(f"{column}=?" for column in updates)
+        with self.lock:
+            cursor = self.connection.execute(
+                f"UPDATE ai_agent SET {assignments} WHERE name=?", (*updates.values(), agent_name)
+            )
+            self.connection.commit()
+            # Writes of this connection do not change its data_version, so the registry is dropped here
+            self.registry = None
+        return cursor.rowcount > 0
@@ -0,0 +1,90 @@
+import re
+import math
+from collections import defaultdict
+
+TERM_PATTERN = re.compile(r"[a-z0-9]+")
+
+STOP_WORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "does", "for", "from", "how", "i",
+    "in", "is", "it", "me", "my", "of", "on", "or", "our", "the", "this", "to", "was", "we", "what",
+    "when", "where", "which", "who", "why", "with", "you", "your",
+}
+
+
+def tokenize_terms(text: str) -> list:
+    '''
+    Normalized terms of a text: lowercased words without stop words.
+    Acronyms like "NSR" are kept as they are, only lowercased.
+    '''
+    return [term for term in TERM_PATTERN.findall(text.lower()) if term not in STOP_WORDS]
+
+
+def reciprocal_rank_fusion(rankings, k: int = 60) -> list:
+    '''
+    Fuse several rankings (lists of ids, best first) into one with reciprocal rank fusion.
+    '''
+    scores = defaultdict(float)
+    for ranking in rankings:
+        for rank, item in enumerate(ranking):
+            scores[item] += 1.0 / (k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+class KeywordIndex:
+    '''
+    In-memory inverted index from normalized terms to weighted agents, scored BM25-style.
+    Every agent is treated as a document whose term frequencies are the term weights: specialization keywords
+    count fully, words of the capability and description count half, and extra weighted terms
+    (e.g. the word2vec representative words of an agent) are added with their own weight.
+    '''
+
+    def __init__(self, agents, extra_terms=None, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.agent_names = []
+        self.postings = defaultdict(list)  # Term -> [(agent index, weight)]
+        self.lengths = []
+        extra_terms = extra_terms or {}
+        for agent in agents:
+            weights = defaultdict(float)
+            keywords = agent.specialization_keywords or []
+            if isinstance(keywords, str):
+                keywords = keywords.split(",")
+            for keyword in keywords:
+                for term in tokenize_terms(keyword):
+                    weights[term] += 1.0
+            for text in (agent.capability, agent.description):
+                for term in tokenize_terms(text or ""):
+                    weights[term] += 0.5
+            for term, weight in extra_terms.get(agent.name, {}).items():
+                for token in tokenize_terms(term):
+                    weights[token] += float(weight)
+            index = len(self.agent_names)
+            self.agent_names.append(agent.name)
+            self.lengths.append(sum(weights.values()))
+            for term, weight in weights.items():
+                self.postings[term].append((index, weight))
+        self.average_length = (sum(self.lengths) / len(self.lengths)) if self.lengths else 0.0
+        count = len(self.agent_names)
+        self.idf = {
+            term: math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for term, postings in self.postings.items()
+        }
+
+    def search(self, query: str, k: int = 3, allowed=None) -> list:
+        """
+        Returns up to k (agent name, score) pairs, best first. Agents without any matching term are left out,
+        and so are the agents not in `allowed` if it is given.
+        """
+        scores = defaultdict(float)
+        for term in set(tokenize_terms(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for index, weight in self.postings[term]:
+                if allowed is not None and self.agent_names[index] not in allowed:
+                    continue
+                norm = 1 - self.b + self.b * self.lengths[index] / (self.average_length or 1.0)
+                scores[index] += idf * weight * (self.k1 + 1) / (weight + self.k1 * norm)
+        best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [(self.agent_names[index], score) for index, score in best]
@@ -0,0 +1,110 @@
+import math
+import sqlite3
+import threading
+from collections import Counter
+from database.keyword_index import tokenize_terms
+
+
+class LexicalIndex:
+    '''
+    Inverted index of documents stored in SQLite and scored with BM25.
+    It is updated incrementally as documents are added, so it can be kept next to a vector collection
+    and catch exact terms like codes and acronyms ("NSR") that embeddings handle poorly.
+    The document count and total length are kept in memory, so a search only reads the postings
+    of the query terms.
+    '''
+
+    def __init__(self, db_path: str, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS lexical_docs (doc_id TEXT PRIMARY KEY, length INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS lexical_postings (
+                term TEXT NOT NULL, doc_id TEXT NOT NULL, tf INTEGER NOT NULL, PRIMARY KEY (term, doc_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS lexical_postings_doc ON lexical_postings (doc_id);
+            """
+        )
+        self.connection.commit()
+        self.doc_count, self.total_length = self.connection.execute(
+            "SELECT COUNT(*), COALESCE(SUM(length), 0) FROM lexical_docs"
+        ).fetchone()
+
+    def add(self, ids, texts):
+        """
+        Index documents, documents whose id is already indexed are re-indexed
+        """
+        with self.lock:
+            self._remove(ids)
+            for id, text in zip(ids, texts):
+                counts = Counter(tokenize_terms(text))
+                length = sum(counts.values())
+                self.connection.execute("INSERT INTO lexical_docs (doc_id, length) VALUES (?, ?)", (id, length))
+                self.connection.executemany(
+                    "INSERT INTO lexical_postings (term, doc_id, tf) VALUES (?, ?, ?)",
+                    [(term, id, tf) for term, tf in counts.items()],
+                )
+                self.doc_count += 1
+                self.total_length += length
+            self.connection.commit()
+
+    def remove(self, ids):
+        with self.lock:
+            self._remove(ids)
+            self.connection.commit()
+
+    def clear(self):
+        with self.lock:
+            self.connection.execute("DELETE FROM lexical_postings")
+            self.connection.execute("DELETE FROM lexical_docs")
+            self.connection.commit()
+            self.doc_count, self.total_length = 0, 0
+
+    def search(self, query: str, k: int = 5) -> list:
+        """
+        Returns up to k (document id, score) pairs, best first. Documents without any query term are left out.
+        """
+        terms = sorted(set(tokenize_terms(query)))
+        if not terms or self.doc_count == 0:
+            return []
+        placeholders = ",".join("?" * len(terms))
+        with self.lock:
+            document_frequency = dict(self.connection.execute(
+                f"SELECT term, COUNT(*) FROM lexical_postings WHERE term IN ({placeholders}) GROUP BY term",
+                terms,
+            ).fetchall())
+            rows = self.connection.execute(
+                f"""
+                SELECT p.term, p.doc_id, p.tf, d.length
+                FROM lexical_postings p JOIN lexical_docs d ON d.doc_id = p.doc_id
+                WHERE p.term IN ({placeholders})
+                """,
+                terms,
+            ).fetchall()
+            doc_count, average_length = self.doc_count, (self.total_length / self.doc_count) or 1.0
+        # Same smoothed BM25 idf as the agent keyword index
+        idf = {
+            term: math.log(1 + (doc_count - df + 0.5) / (df + 0.5)) for term, df in document_frequency.items()
+        }
+        scores = Counter()
+        for term, doc_id, tf, length in rows:
+            norm = 1 - self.b + self.b * length / average_length
+            scores[doc_id] += idf[term] * tf * (self.k1 + 1) / (tf + self.k1 * norm)
+        return scores.most_common(k)
+
+    def __len__(self):
+        return self.doc_count
+
+    def _remove(self, ids):
+        for id in ids:
+            row = self.connection.execute("SELECT length FROM lexical_docs WHERE doc_id=?", (id,)).fetchone()
+            if row is None:
+                continue
+            self.connection.execute("DELETE FROM lexical_postings WHERE doc_id=?", (id,))
+            self.connection.execute("DELETE FROM lexical_docs WHERE doc_id=?", (id,))
+            self.doc_count -= 1
+            self.total_length -= row[0]
+
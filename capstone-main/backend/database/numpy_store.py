@@ -0,0 +1,533 @@
+import os
+import re
+import copy
+import json
+import shutil
+import threading
+import numpy as np
+from database.vector_store import VectorStore, AgentIndexMixin, AGENT_METADATA_TYPES, text_metadatas
+from database.agent_index import matches_filter
+
+QUANTIZATIONS = ("int8", "float16", None)
+
+
+def quantize(vectors, quantization="int8"):
+    '''
+    Scalar quantization of float32 vectors, returns the codes and the per-vector scales.
+    int8 codes are the vector divided by max(|v|) / 127, so code * scale approximates the vector.
+    float16 codes and unquantized (None) codes have a scale of 1.
+    '''
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if quantization == "int8":
+        scales = np.abs(vectors).max(axis=1) / 127
+        scales[scales == 0] = 1
+        codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+        return codes, scales.astype(np.float32)
+    if quantization == "float16":
+        return vectors.astype(np.float16), np.ones(len(vectors), dtype=np.float32)
+    if quantization is None:
+        return vectors, np.ones(len(vectors), dtype=np.float32)
+    raise ValueError(f"Unknown quantization {quantization}, expected one of {QUANTIZATIONS}")
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors[None, :]
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def assign_lists(vectors, centroids, block_size=32768):
+    # Index of the closest centroid of each normalized vector
+    lists = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), block_size):
+        block = np.asarray(vectors[start:start + block_size], dtype=np.float32)
+        lists[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return lists
+
+
+def kmeans(vectors, n_clusters, iterations=20, seed=0):
+    '''
+    Spherical k-means of normalized vectors, returns the (n_clusters, dim) normalized centroids.
+    Clusters which end up empty are restarted on a random vector.
+    '''
+    rng = np.random.default_rng(seed)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+    for _ in range(iterations):
+        lists = assign_lists(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, lists, vectors)
+        empty = np.flatnonzero(np.bincount(lists, minlength=n_clusters) == 0)
+        sums[empty] = vectors[rng.choice(len(vectors), len(empty))]
+        centroids = normalize(sums)
+    return centroids
+
+
+class Segment:
+    '''
+    An immutable block of vectors saved in its own directory:
+    codes.npy (quantized vectors), scales.npy, vectors.npy (float32, only read to rescore candidates),
+    records.jsonl (one JSON line with the id, document and metadata of each vector) and
+    record_offsets.npy (the byte offset of each line). Unquantized segments have no vectors.npy,
+    their codes are the float32 vectors.
+    Once the collection has an IVF coarse quantizer, lists_<version>.npy holds the list (closest centroid) of each
+    vector for the centroids of that training version. A segment is never changed once a collection uses it,
+    new lists give a new Segment object, see with_lists.
+    All the files are memory-mapped, so loading a segment does not copy the vectors or the texts
+    and only the pages touched by a search end up in memory. A record is only parsed when it is read.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.codes = np.load(os.path.join(path, "codes.npy"), mmap_mode="r")
+        self.scales = np.load(os.path.join(path, "scales.npy"), mmap_mode="r")
+        vectors_path = os.path.join(path, "vectors.npy")
+        self.vectors = np.load(vectors_path, mmap_mode="r") if os.path.exists(vectors_path) else self.codes
+        self.record_offsets = np.load(os.path.join(path, "record_offsets.npy"), mmap_mode="r")
+        self.record_blob = np.memmap(os.path.join(path, "records.jsonl"), dtype=np.uint8, mode="r")
+        self.lists = None
+        self.list_order = None
+        self.list_offsets = None
+
+    def load_lists(self, version):
+        """
+        A copy of the segment with the IVF lists saved for a training version, or None if they were never saved
+        """
+        lists_path = os.path.join(self.path, f"lists_{version:06d}.npy")
+        if not os.path.exists(lists_path):
+            return None
+        segment = copy.copy(self)
+        segment._index_lists(np.load(lists_path))
+        return segment
+
+    def with_lists(self, lists, version):
+        """
+        A copy of the segment with the IVF list of each vector, saved next to the segment for the training version.
+        This segment is not changed, so searches which still hold it keep lists that match their centroids.
+        """
+        lists = np.asarray(lists, dtype=np.int32)
+        tmp_path = os.path.join(self.path, f"lists_{version:06d}.tmp.npy")
+        np.save(tmp_path, lists)
+        os.replace(tmp_path, os.path.join(self.path, f"lists_{version:06d}.npy"))
+        segment = copy.copy(self)
+        segment._index_lists(lists)
+        return segment
+
+    def remove_lists(self, keep_version):
+        # Delete the lists saved for the other training versions
+        for name in os.listdir(self.path):
+            match = re.fullmatch(r"lists_(\d+)\.npy", name)
+            if match and int(match.group(1)) != keep_version:
+                os.remove(os.path.join(self.path, name))
+
+    def _index_lists(self, lists):
+        # Inverted lists: the rows of list c are list_order[list_offsets[c]:list_offsets[c + 1]]
+        lists = np.asarray(lists)
+        self.list_order = np.argsort(lists, kind="stable")
+        self.list_offsets = np.concatenate([[0], np.cumsum(np.bincount(lists))])
+        self.lists = lists
+
+    def list_rows(self, probes):
+        """
+        The rows of the given IVF lists
+        """
+        n_lists = len(self.list_offsets) - 1
+        return np.concatenate(
+            [self.list_order[self.list_offsets[c]:self.list_offsets[c + 1]] for c in probes if c < n_lists]
+            or [np.zeros(0, dtype=np.int64)]
+        )
+
+    def record(self, row) -> dict:
+        """
+        The id, document and metadata of a row, parsed from its line of records.jsonl
+        """
+        start, end = self.record_offsets[row], self.record_offsets[row + 1]
+        return json.loads(self.record_blob[start:end].tobytes())
+
+    @classmethod
+    def write(cls, path, vectors, records, quantization="int8"):
+        """
+        Write a new segment, it only becomes visible once it is complete
+        """
+        codes, scales = quantize(vectors, quantization)
+        lines = [(json.dumps(record) + "\n").encode("utf-8") for record in records]
+        offsets = np.zeros(len(lines) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(line) for line in lines])
+        tmp_path = path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        np.save(os.path.join(tmp_path, "codes.npy"), codes)
+        np.save(os.path.join(tmp_path, "scales.npy"), scales)
+        if quantization is not None:
+            np.save(os.path.join(tmp_path, "vectors.npy"), np.asarray(vectors, dtype=np.float32))
+        np.save(os.path.join(tmp_path, "record_offsets.npy"), offsets)
+        with open(os.path.join(tmp_path, "records.jsonl"), "wb") as file:
+            file.writelines(lines)
+        os.rename(tmp_path, path)
+        return cls(path)
+
+    def approximate_scores(self, queries, rows=None, block_size=32768):
+        # Approximate inner products (len(rows), len(queries)) computed on the codes, one block at a time
+        # so only a block of the codes is converted to float32 at once
+        if rows is None:
+            rows = np.arange(len(self.codes))
+        scores = np.empty((len(rows), len(queries)), dtype=np.float32)
+        for start in range(0, len(rows), block_size):
+            block = rows[start:start + block_size]
+            codes = np.asarray(self.codes[block], dtype=np.float32)
+            scores[start:start + len(block)] = (codes @ queries.T) * self.scales[block][:, None]
+        return scores
+
+    def __len__(self):
+        return len(self.record_offsets) - 1
+
+
+class SegmentCollection:
+    '''
+    Append-only collection of segments in a directory, every add writes a new segment.
+    Segments are never rewritten, delete() only records the ids of the deleted rows in deleted_ids.jsonl
+    (tombstones) and searches and get() skip those rows.
+    A search scores the quantized codes of all segments, keeps the `rescore_factor * k` best candidates
+    and reorders them with their float32 vectors. Distances are 2 - 2 * cosine, the squared L2 distance
+    of the normalized vectors.
+    With index="ivf" a k-means coarse quantizer of `n_lists` centroids (4 * sqrt(count) by default) is trained
+    once the collection has `ivf_min_vectors` vectors, or by calling train(). A search then only scores
+    the vectors in the `nprobe` lists closest to the query; index="flat" always scores every vector.
+    New vectors are assigned to the existing lists, call train() again to retrain after large changes.
+    Training reads only a sample of rows from each segment and runs outside the collection lock, the automatic
+    training started by add() in a background thread, so adds and searches go on while it runs. The new lists
+    are built on copies of the segments and swapped in together with the new centroids under the lock.
+    Each training has a version: centroids_<version>.npy and the lists_<version>.npy of the segments,
+    so after a crash in the middle of a training the previous centroids and lists are still used together.
+    '''
+
+    def __init__(
+        self, path, quantization="int8", rescore_factor=4, index="flat", n_lists=None, nprobe=8, ivf_min_vectors=10000
+    ):
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"Unknown quantization {quantization}, expected one of {QUANTIZATIONS}")
+        if index not in ("flat", "ivf"):
+            raise ValueError(f"Unknown index {index}, expected 'flat' or 'ivf'")
+        self.path = path
+        self.quantization = quantization
+        self.rescore_factor = rescore_factor
+        self.index = index
+        self.n_lists = n_lists
+        self.nprobe = nprobe
+        self.ivf_min_vectors = ivf_min_vectors
+        self.lock = threading.Lock()
+        self.training = False  # Set while a training runs, so only one runs at a time
+        os.makedirs(path, exist_ok=True)
+        self.deleted = set()  # Ids of the deleted rows, replaced (not changed) on every delete
+        deleted_path = os.path.join(path, "deleted_ids.jsonl")
+        if os.path.exists(deleted_path):
+            with open(deleted_path, encoding="utf-8") as file:
+                self.deleted = {json.loads(line) for line in file if line.strip()}
+        names = sorted(
+            name for name in os.listdir(path)
+            if name.startswith("segment_") and not name.endswith(".tmp")
+        )
+        self.segments = [Segment(os.path.join(path, name)) for name in names]
+        self.centroids = None
+        self.ivf_version = 0  # Version of the latest training, 0 before the first one
+        versions = [
+            int(match.group(1)) for match in
+            (re.fullmatch(r"centroids_(\d+)\.npy", name) for name in os.listdir(path)) if match
+        ]
+        if index == "ivf" and versions:
+            self.ivf_version = max(versions)
+            self.centroids = np.load(os.path.join(path, f"centroids_{self.ivf_version:06d}.npy"))
+            self.segments = [
+                segment.load_lists(self.ivf_version)
+                or segment.with_lists(assign_lists(segment.vectors, self.centroids), self.ivf_version)
+                for segment in self.segments
+            ]
+
+    def add(self, ids, documents, embeddings, metadatas):
+        """
+        Add vectors with their ids, documents and metadatas as a new segment
+        """
+        if not ids:
+            return
+        records = [
+            {"id": id, "document": document, "metadata": metadata}
+            for id, document, metadata in zip(ids, documents, metadatas)
+        ]
+        with self.lock:
+            path = os.path.join(self.path, f"segment_{len(self.segments):06d}")
+            segment = Segment.write(path, normalize(embeddings), records, self.quantization)
+            if self.centroids is not None:
+                segment = segment.with_lists(assign_lists(segment.vectors, self.centroids), self.ivf_version)
+            self.segments = self.segments + [segment]
+            train = (
+                self.index == "ivf" and self.centroids is None and not self.training
+                and self.count() >= self.ivf_min_vectors
+            )
+            if train:
+                self.training = True
+        if train:
+            threading.Thread(target=self._train, daemon=True).start()
+
+    def train(self, n_lists=None, sample_size=100000, iterations=20):
+        """
+        Train the IVF coarse quantizer on a sample of the vectors and assign every vector to its list.
+        Runs in the calling thread and does nothing if a training is already running.
+        """
+        with self.lock:
+            if self.training:
+                return
+            self.training = True
+        self._train(n_lists, sample_size, iterations)
+
+    def _train(self, n_lists=None, sample_size=100000, iterations=20):
+        # Called with self.training set, the heavy work runs on a snapshot of the segments without the lock
+        try:
+            segments = self.segments
+            version = self.ivf_version + 1
+            count = sum(len(segment) for segment in segments)
+            if count == 0:
+                return
+            n_lists = min(n_lists or self.n_lists or max(1, int(4 * np.sqrt(count))), count)
+            sample = self._sample_vectors(segments, min(sample_size, count))
+            centroids = kmeans(sample, n_lists, iterations)
+            new_segments = [
+                segment.with_lists(assign_lists(segment.vectors, centroids), version) for segment in segments
+            ]
+            with self.lock:
+                # Segments added during the training were assigned to the old lists, if any
+                new_segments += [
+                    segment.with_lists(assign_lists(segment.vectors, centroids), version)
+                    for segment in self.segments[len(segments):]
+                ]
+                # The centroids file is written last: until it exists, a restart loads the previous version
+                tmp_path = os.path.join(self.path, "centroids.tmp.npy")
+                np.save(tmp_path, centroids)
+                os.replace(tmp_path, os.path.join(self.path, f"centroids_{version:06d}.npy"))
+                self.segments, self.centroids, self.ivf_version = new_segments, centroids, version
+            for segment in new_segments:
+                segment.remove_lists(version)
+            for name in os.listdir(self.path):
+                match = re.fullmatch(r"centroids_(\d+)\.npy", name)
+                if match and int(match.group(1)) != version:
+                    os.remove(os.path.join(self.path, name))
+            print(f"Trained IVF index of {self.path} with {n_lists} lists on {len(sample)} vectors.")
+        finally:
+            self.training = False
+
+    def _sample_vectors(self, segments, sample_size, seed=0):
+        # Uniform sample of rows over all segments, only the sampled rows are read from each segment
+        sizes = [len(segment) for segment in segments]
+        count = sum(sizes)
+        rng = np.random.default_rng(seed)
+        rows = np.sort(rng.choice(count, sample_size, replace=False)) if sample_size < count else np.arange(count)
+        bounds = np.searchsorted(rows, np.cumsum([0] + sizes))
+        start = 0
+        parts = []
+        for segment, size, lo, hi in zip(segments, sizes, bounds[:-1], bounds[1:]):
+            parts.append(np.asarray(segment.vectors[rows[lo:hi] - start], dtype=np.float32))
+            start += size
+        return np.concatenate(parts)
+
+    def query(self, query_embeddings, n_results=5) -> dict:
+        """
+        Returns the n_results closest records of each query, shaped like the result of a Chroma query
+        """
+        queries = normalize(query_embeddings)
+        # Adds and trainings replace the list of segments and the centroids together under the lock,
+        # so this snapshot stays consistent
+        with self.lock:
+            segments, centroids = self.segments, self.centroids
+        deleted = self.deleted
+        probes = None
+        if centroids is not None:
+            nprobe = min(self.nprobe, len(centroids))
+            probes = np.argpartition(-(queries @ centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+        results = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+        candidates = [self._candidates(segment, queries, n_results, probes) for segment in segments]
+        for q, query in enumerate(queries):
+            scored = []
+            for segment, segment_candidates in zip(segments, candidates):
+                rows, scores = segment_candidates[q]
+                scored += [(score, segment, row) for row, score in zip(rows, scores)]
+            # Keep the best approximate candidates and rescore them with the float32 vectors
+            scored.sort(key=lambda item: item[0], reverse=True)
+            scored = scored[:n_results * self.rescore_factor]
+            if self.quantization is not None:
+                scored = [(float(segment.vectors[row] @ query), segment, row) for _, segment, row in scored]
+                scored.sort(key=lambda item: item[0], reverse=True)
+            if deleted:
+                # Keep the best candidates which are not deleted, up to n_results
+                kept = [(score, segment, row, segment.record(row)) for score, segment, row in scored]
+                kept = [item for item in kept if item[3]["id"] not in deleted][:n_results]
+                scored = [(score, segment, row) for score, segment, row, _ in kept]
+                records = [record for _, _, _, record in kept]
+            else:
+                scored = scored[:n_results]
+                records = [segment.record(row) for _, segment, row in scored]
+            results["ids"].append([record["id"] for record in records])
+            results["documents"].append([record["document"] for record in records])
+            results["metadatas"].append([record["metadata"] for record in records])
+            results["distances"].append([float(2 - 2 * score) for score, _, _ in scored])
+        return results
+
+    def _candidates(self, segment, queries, n_results, probes=None):
+        # (rows, approximate scores) of the best candidates of each query in a segment
+        m = n_results * self.rescore_factor
+        if probes is None or segment.lists is None:
+            scores = segment.approximate_scores(queries).T  # (queries, rows)
+            m = min(m, scores.shape[1])
+            top = np.argpartition(-scores, m - 1, axis=1)[:, :m]
+            return list(zip(top, np.take_along_axis(scores, top, axis=1)))
+        candidates = []
+        for q in range(len(queries)):
+            rows = segment.list_rows(probes[q])
+            if len(rows) == 0:
+                candidates.append((rows, np.zeros(0, dtype=np.float32)))
+                continue
+            scores = segment.approximate_scores(queries[q:q + 1], rows)[:, 0]
+            top = np.argpartition(-scores, min(m, len(rows)) - 1)[:m]
+            candidates.append((rows[top], scores[top]))
+        return candidates
+
+    def get(self, include=None) -> dict:
+        """
+        All the records with their float32 embeddings, `include` is accepted like in Chroma but everything is returned
+        """
+        segments, deleted = self.segments, self.deleted
+        rows = [
+            (segment.record(row), segment, row)
+            for segment in segments for row in range(len(segment))
+        ]
+        rows = [(record, segment, row) for record, segment, row in rows if record["id"] not in deleted]
+        return {
+            "ids": [record["id"] for record, _, _ in rows],
+            "documents": [record["document"] for record, _, _ in rows],
+            "metadatas": [record["metadata"] for record, _, _ in rows],
+            "embeddings": [np.asarray(segment.vectors[row]) for _, segment, row in rows],
+        }
+
+    def delete(self, where) -> int:
+        """
+        Delete the rows whose metadata match a filter (see matches_filter) by adding their ids to the tombstones,
+        returns the number of deleted rows. The vectors stay in their segments, so deleted rows still take up space.
+        """
+        with self.lock:
+            ids = [
+                record["id"]
+                for segment in self.segments for record in map(segment.record, range(len(segment)))
+                if record["id"] not in self.deleted and matches_filter(record["metadata"], where)
+            ]
+            if ids:
+                with open(os.path.join(self.path, "deleted_ids.jsonl"), "a", encoding="utf-8") as file:
+                    file.writelines(json.dumps(id) + "\n" for id in ids)
+                self.deleted = self.deleted | set(ids)
+            return len(ids)
+
+    def count(self) -> int:
+        # Stored rows including the deleted ones, so ids built from the count stay unique
+        return sum(len(segment) for segment in self.segments)
+
+
+class NumpyVectorStore(AgentIndexMixin, VectorStore):
+    '''
+    Vector store on NumPy arrays with quantized, memory-mapped storage.
+    The documents and the agent metadata are kept in two SegmentCollections under db_path.
+    `quantization` is "int8", "float16" or None. Searches scan the codes, which are 4x (int8) or 2x (float16)
+    smaller than float32, but the float32 vectors are stored too for the rescoring, so on disk a quantized
+    collection takes about 1.25x (int8) or 1.5x (float16) the size of the float32 vectors alone.
+    `embedding_function` is a LangChain Embeddings, an HTTPEmbeddingModel with a cache by default.
+    `index`, `nprobe` and `ivf_min_vectors` choose between exact flat search and IVF search, see SegmentCollection.
+    Agent searches use an AgentCentroidIndex built from the agent vectors, so they can be filtered on the agent attributes.
+    '''
+
+    def __init__(
+        self,
+        db_path: str,
+        embedding_function=None,
+        quantization="int8",
+        rescore_factor=4,
+        index="flat",
+        nprobe=8,
+        ivf_min_vectors=10000,
+    ):
+        if embedding_function is None:
+            from documents.embeddings import HTTPEmbeddingModel
+            from documents.embedding_cache import EmbeddingCache
+
+            os.makedirs(db_path, exist_ok=True)
+            cache_path = os.path.join(db_path, "embedding_cache.db")
+            embedding_function = HTTPEmbeddingModel(cache=EmbeddingCache(db_path=cache_path))
+        self.db_path = db_path
+        self.embedding_function = embedding_function
+        self.docs_collection = SegmentCollection(
+            os.path.join(db_path, "documents"), quantization, rescore_factor,
+            index=index, nprobe=nprobe, ivf_min_vectors=ivf_min_vectors,
+        )
+        self.agents_collection = SegmentCollection(
+            os.path.join(db_path, "agents"), quantization, rescore_factor,
+            index=index, nprobe=nprobe, ivf_min_vectors=ivf_min_vectors,
+        )
+        self.agent_index = None
+        self.agent_index_lock = threading.Lock()
+        self.agent_attributes = {}  # Agent name -> filter attributes, set from the agent registry
+
+    def warmup(self):
+        # Load the embedding model and the agent index before the first request
+        self.get_agent_index()
+        self.embed_texts(["warmup"])
+
+    def embed_texts(self, texts):
+        return self.embedding_function.embed_documents(list(texts))
+
+    def add_texts(self, texts, filename, metadatas=None):
+        offset = self.docs_collection.count()
+        self.docs_collection.add(
+            ids=[f"{filename}_{offset + i}" for i in range(len(texts))],
+            documents=texts,
+            embeddings=self.embed_texts(texts),
+            metadatas=text_metadatas(texts, filename, metadatas),
+        )
+
+    def similarity_search_docs(self, query_text, k=5):
+        return self.docs_collection.query(self.embed_texts([query_text]), n_results=k)
+
+    def add_agent_metadata(self, agent_name, metadata, filename, replace=False):
+        # With replace=True the previous metadata of the agent is deleted (tombstoned) in the collection
+        # and the agent is rebuilt in the index from the new metadata only
+        texts = [metadata[name] for name in AGENT_METADATA_TYPES]
+        attributes = self.agent_attributes.get(agent_name, {})
+        embeddings = self.embed_texts(texts)
+        # The index is loaded before the add so the new vectors are added to it exactly once
+        index = self.get_agent_index()
+        if replace:
+            self.agents_collection.delete(where={"agent_name": agent_name})
+            index.remove(agent_name)
+        offset = self.agents_collection.count()
+        ids = [f"{agent_name}_{name}_{offset + i}" for i, name in enumerate(AGENT_METADATA_TYPES)]
+        self.agents_collection.add(
+            ids=ids,
+            documents=texts,
+            embeddings=embeddings,
+            metadatas=[
+                {"agent_name": agent_name, "filename": filename, "type": name, **attributes}
+                for name in AGENT_METADATA_TYPES
+            ],
+        )
+        index.add(agent_name, ids, embeddings, texts, attributes)
+
+    def set_agent_attributes(self, agent_name, attributes):
+        # The segments are immutable, the attributes are only kept in memory and set again from the registry on startup
+        self.agent_attributes[agent_name] = {**self.agent_attributes.get(agent_name, {}), **attributes}
+        with self.agent_index_lock:
+            index = self.agent_index
+        if index is not None:
+            index.set_attributes(agent_name, attributes)
+
+    def similarity_search_agents(self, query_text, k=5, where=None):
+        return self.similarity_search_agents_batch([query_text], k, where)[0]
+
+    def similarity_search_agents_batch(self, query_texts, k=5, where=None):
+        if not query_texts:
+            return []
+        return self._search_agent_index(list(query_texts), k, where)
@@ -1,31 +1,158 @@
-from langchain_community.vectorstores import SQLiteVSS
-from documents.embeddings import HTTPEmbeddingModel
-from chromadb.config import Settings
-from chromadb import PersistentClient
-from chromadb.utils.embedding_functions import DefaultEmbeddingFunction
-import uuid
+# The store backends are imported inside their constructors so importing this module stays cheap
+# and only the backend that is actually used gets loaded.
+import os
+import asyncio
+import hashlib
+import threading
+from database.agent_index import AgentCentroidIndex
+from database.lexical_index import LexicalIndex
+from database.keyword_index import reciprocal_rank_fusion
+
+AGENT_METADATA_TYPES = ["capabilities", "description", "keywords"]
+
+
+def content_id(*parts) -> str:
+    """
+    Deterministic id of a piece of content, the same parts always give the same id
+    """
+    return hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()[:32]
+
+
+def chroma_where(where):
+    """
+    Chroma `where` clause of an agent filter, lists of values become $in conditions
+    """
+    if not where:
+        return None
+    clauses = [
+        {key: {"$in": list(value)}} if isinstance(value, (list, tuple, set)) else {key: value}
+        for key, value in where.items()
+    ]
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+
+def text_metadatas(texts, filename, metadatas=None) -> list:
+    # Metadata of each added document text, the extra metadatas are merged in
+    return [
+        {"source": "user", "filename": filename, **(metadatas[i] if metadatas else {})}
+        for i in range(len(texts))
+    ]
 
 
 class VectorStore:
-    def add_texts(self, texts, metadata):
+    def add_texts(self, texts, filename, metadatas=None):
+        # `metadatas` are optional extra metadata per text, e.g. the page and offset of a chunk
         raise NotImplementedError
 
     def similarity_search_docs(self, query_text, k=5):
         raise NotImplementedError
 
-    def add_agent_metadata(self, agent_name, metadata):
+    def add_agent_metadata(self, agent_name, metadata, filename, replace=False):
+        # With replace=True the previous metadata of the agent is removed first
         raise NotImplementedError
 
-    def similarity_search_agents(self, query_text, k=5):
+    def similarity_search_agents(self, query_text, k=5, where=None):
+        # `where` filters the agents on their attributes before the top-k, e.g. {"online": True}
         raise NotImplementedError
 
+    def similarity_search_agents_batch(self, query_texts, k=5, where=None):
+        # Stores without a multi-query search run the queries one by one
+        return [self.similarity_search_agents(query_text, k, where) for query_text in query_texts]
+
+    def set_agent_attributes(self, agent_name, attributes):
+        # Filter attributes of an agent (online, is_public, agent_type), kept in sync with the agent registry
+        raise NotImplementedError
+
+    def embed_texts(self, texts):
+        raise NotImplementedError
+
+    def warmup(self):
+        # Stores which load models or indexes lazily load them here, before the first request
+        pass
+
+    async def asimilarity_search_docs(self, query_text, k=5):
+        # The stores only offer blocking clients, so the search runs in a worker thread
+        return await asyncio.to_thread(self.similarity_search_docs, query_text, k)
+
+    async def asimilarity_search_agents(self, query_text, k=5, where=None):
+        return await asyncio.to_thread(self.similarity_search_agents, query_text, k, where)
+
+    async def asimilarity_search_agents_batch(self, query_texts, k=5, where=None):
+        return await asyncio.to_thread(self.similarity_search_agents_batch, query_texts, k, where)
+
+    async def aembed_texts(self, texts):
+        return await asyncio.to_thread(self.embed_texts, texts)
+
+
+class AgentIndexMixin:
+    '''
+    Agent searches answered from an AgentCentroidIndex, for the stores which keep the agent embeddings
+    in an `agents_collection` with a Chroma-like get(). The store sets `agent_index` (None until first use),
+    `agent_index_lock` and `agent_attributes` (agent name -> filter attributes) in its constructor.
+    '''
+
+    def get_agent_index(self) -> AgentCentroidIndex:
+        """
+        The agent centroid index, built from the embeddings stored in the `agents` collection on first use
+        """
+        with self.agent_index_lock:
+            if self.agent_index is None:
+                self.agent_index = AgentCentroidIndex.from_collection(self.agents_collection)
+                for agent_name, attributes in self.agent_attributes.items():
+                    self.agent_index.set_attributes(agent_name, attributes)
+                print(f"Agent index built with {len(self.agent_index)} agents.")
+            return self.agent_index
+
+    def _search_agent_index(self, query_texts, k, where=None):
+        # Same result shape as a Chroma query, with one entry per distinct agent
+        # The ids and documents are those of each agent's stored chunk closest to the query
+        index = self.get_agent_index()
+        query_vectors = self.embed_texts(query_texts)
+        matches = index.search(query_vectors, k, where)
+        chunks = [
+            [index.best_chunk(name, query_vector) for name, _ in row]
+            for row, query_vector in zip(matches, query_vectors)
+        ]
+        results = {
+            'ids': [[id for id, _ in row] for row in chunks],
+            'documents': [[document for _, document in row] for row in chunks],
+            'metadatas': [[{"agent_name": name, "type": "centroid"} for name, _ in row] for row in matches],
+            'distances': [[distance for _, distance in row] for row in matches],
+        }
+        return [self._filter_agent_results(results, i) for i in range(len(query_texts))]
+
+    def _filter_agent_results(self, results, i):
+        # Keep the results of the i-th query which are within the distance threshold
+        threshold = 1.5  # Set your desired threshold
+        filtered_results = {
+            'ids': [],
+            'documents': [],
+            'metadatas': [],
+            'distances': []
+        }
+        for j, distance in enumerate(results['distances'][i]):
+            if distance <= threshold:
+                # Append the filtered items
+                filtered_results['ids'].append(results['ids'][i][j])
+                filtered_results['documents'].append(results['documents'][i][j])
+                filtered_results['metadatas'].append(results['metadatas'][i][j])
+                filtered_results['distances'].append(distance)
+        return filtered_results
+
 
 class SQLLiteVectorStore(VectorStore):
     def __init__(self, db_path: str, embedding_function=None):
+        from langchain_community.vectorstores import SQLiteVSS
+        from documents.embeddings import HTTPEmbeddingModel
+        from documents.embedding_cache import EmbeddingCache
+
         self.db_path = db_path
         connection = SQLiteVSS.create_connection(db_file=db_path)
         if embedding_function is None:
-            embedding_function = HTTPEmbeddingModel()
+            # Cache the embeddings next to the database so re-ingested texts are not embedded again
+            cache_path = os.path.join(os.path.dirname(db_path), "embedding_cache.db")
+            embedding_function = HTTPEmbeddingModel(cache=EmbeddingCache(db_path=cache_path))
+        self.embedding_function = embedding_function
 
         self.db = SQLiteVSS(
             table="embeddings", embedding=embedding_function, connection=connection
@@ -34,15 +161,20 @@ class SQLLiteVectorStore(VectorStore):
             table="agents", connection=connection, embedding=embedding_function
         )
 
-    def add_texts(self, texts, filename):
+    def add_texts(self, texts, filename, metadatas=None):
         self.db.add_texts(
-            texts, metadata=[{"source": "user", "filename": filename} for _ in texts]
+            texts, metadatas=text_metadatas(texts, filename, metadatas)
         )
 
     def similarity_search_docs(self, query_text, k=5):
         return self.db.similarity_search(query_text, k)
 
-    def add_agent_metadata(self, agent_name, metadata, filename):
+    def embed_texts(self, texts):
+        return self.embedding_function.embed_documents(texts)
+
+    def add_agent_metadata(self, agent_name, metadata, filename, replace=False):
+        if replace:
+            raise NotImplementedError("The SQLite store does not support replacing agent metadata.")
         self.agent_db.add_texts(
             [
                 metadata["capabilities"],
@@ -55,7 +187,9 @@ class SQLLiteVectorStore(VectorStore):
             ],
         )
 
-    def similarity_search_agents(self, query_text, k=5):
+    def similarity_search_agents(self, query_text, k=5, where=None):
+        if where:
+            raise NotImplementedError("The SQLite store does not support filtering the agents.")
         print("Searching for similar agents...")
         print("Query:", query_text)
         print("k:", k)
@@ -66,9 +200,18 @@ class SQLLiteVectorStore(VectorStore):
             return None
 
 
-class ChromaDBVectorStore(VectorStore):
-    def __init__(self, db_path: str, embedding_function=None):
+class ChromaDBVectorStore(AgentIndexMixin, VectorStore):
+    def __init__(self, db_path: str, embedding_function=None, use_agent_index: bool = True, hybrid_docs: bool = True):
+        from chromadb import PersistentClient
+        from chromadb.utils.embedding_functions import DefaultEmbeddingFunction
+
         self.db_path = db_path
+        # With the agent index the agent searches are answered from one in-memory vector per agent
+        # instead of the chunks of the `agents` collection, see AgentCentroidIndex
+        self.use_agent_index = use_agent_index
+        self.agent_index = None
+        self.agent_index_lock = threading.Lock()
+        self.agent_attributes = {}  # Agent name -> filter attributes, set from the agent registry
 
         # Initialize the ChromaDB client
         self.client = PersistentClient(path=db_path)
@@ -76,8 +219,11 @@ class ChromaDBVectorStore(VectorStore):
         # Set up embedding function
         if embedding_function is None:
             embedding_function = DefaultEmbeddingFunction()
+        self.embedding_function = embedding_function
 
-        # Create or get collections for documents and agents
+        # Create or get collections for documents and agents, after undoing an interrupted compaction
+        for name in ("documents", "agents"):
+            self._recover_compaction(name)
         self.docs_collection = self.client.get_or_create_collection(
             name="documents", embedding_function=embedding_function
         )
@@ -85,69 +231,260 @@ class ChromaDBVectorStore(VectorStore):
             name="agents", embedding_function=embedding_function
         )
 
-    def add_texts(self, texts, filename):
-        # Add documents to the `documents` collection
-        self.docs_collection.add(
-            documents=texts,
-            metadatas=[{"source": "user", "filename": filename} for _ in texts],
-            ids=[f"{filename}_{i}" for i in range(len(texts))],
+        # With hybrid_docs the documents are also kept in a BM25 index next to the Chroma directory,
+        # and the document searches fuse the dense and the lexical rankings
+        self.lexical_index = None
+        if hybrid_docs:
+            self.lexical_index = LexicalIndex(db_path.rstrip("/\\") + "_lexical.db")
+            if len(self.lexical_index) == 0 and self.docs_collection.count() > 0:
+                self._index_existing_docs()
+
+    def _find_collection(self, name):
+        try:
+            return self.client.get_collection(name=name, embedding_function=self.embedding_function)
+        except Exception:
+            return None
+
+    def _recover_compaction(self, name):
+        """
+        Clean up after a compaction of `name` which was interrupted, so no data is left only in a temporary collection.
+        The compaction renames the old collection to <name>_backup before <name>_compacted takes its name,
+        so when <name> is missing, or is an empty collection created after the data was moved away,
+        the backup (or else the complete compacted copy) is renamed back. Leftovers are then deleted.
+        """
+        collection = self._find_collection(name)
+        leftovers = {
+            leftover_name: leftover
+            for leftover_name in (f"{name}_backup", f"{name}_compacted")
+            if (leftover := self._find_collection(leftover_name)) is not None
+        }
+        if collection is not None and collection.count() == 0:
+            if any(leftover.count() > 0 for leftover in leftovers.values()):
+                self.client.delete_collection(name)
+                collection = None
+        if collection is None and leftovers:
+            # The backup is preferred, unless only the compacted copy has data
+            source_name = next(
+                (leftover_name for leftover_name, leftover in leftovers.items() if leftover.count() > 0),
+                next(iter(leftovers)),
+            )
+            leftovers.pop(source_name).modify(name=name)
+            print(f"Restored the {name} collection from {source_name} of an interrupted compaction.")
+        # With <name> in place the backup is outdated and the compacted copy may be incomplete
+        for leftover_name in leftovers:
+            self.client.delete_collection(leftover_name)
+
+    def _index_existing_docs(self, batch_size=1000):
+        # Fill the lexical index with the documents which were added before it existed
+        offset = 0
+        while True:
+            batch = self.docs_collection.get(include=["documents"], limit=batch_size, offset=offset)
+            if not batch["ids"]:
+                break
+            self.lexical_index.add(batch["ids"], batch["documents"])
+            offset += len(batch["ids"])
+        print(f"Lexical index built with {offset} documents.")
+
+    def warmup(self):
+        # Run one query so the embedding model and the agents index are loaded before the first request
+        if self.use_agent_index:
+            self.get_agent_index()
+            self.embed_texts(["warmup"])
+        elif self.agents_collection.count() > 0:
+            self.agents_collection.query(query_texts=["warmup"], n_results=1)
+
+    def add_texts(self, texts, filename, metadatas=None):
+        # Upsert documents in the `documents` collection, the ids are content hashes
+        # so uploading the same text of a file again does not add a duplicate
+        unique = {}  # Id -> (text, metadata), the first occurrence of a text is kept
+        for text, metadata in zip(texts, text_metadatas(texts, filename, metadatas)):
+            unique.setdefault(f"{filename}_{content_id(filename, text)}", (text, metadata))
+        self.docs_collection.upsert(
+            documents=[text for text, _ in unique.values()],
+            metadatas=[metadata for _, metadata in unique.values()],
+            ids=list(unique),
         )
+        if self.lexical_index is not None:
+            self.lexical_index.add(list(unique), [text for text, _ in unique.values()])
 
     def similarity_search_docs(self, query_text, k=5):
         # Perform similarity search on the `documents` collection
-        results = self.docs_collection.query(query_texts=[query_text], n_results=k)
-        return results
-
-    def add_agent_metadata(self, agent_name, metadata, filename):
-        # Add agent metadata to the `agents` collection
-        texts = [
-            metadata["capabilities"],
-            metadata["description"],
-            metadata["keywords"],
-        ]
+        if self.lexical_index is None:
+            return self.docs_collection.query(query_texts=[query_text], n_results=k)
+        # Hybrid search: the dense and the BM25 rankings of 2k documents are fused with reciprocal rank fusion.
+        # Documents only found by BM25 have no distance.
+        depth = 2 * k
+        dense = self.docs_collection.query(query_texts=[query_text], n_results=depth)
+        lexical = self.lexical_index.search(query_text, depth)
+        found = {
+            id: (document, metadata, distance)
+            for id, document, metadata, distance in zip(
+                dense["ids"][0], dense["documents"][0], dense["metadatas"][0], dense["distances"][0]
+            )
+        }
+        missing = [id for id, _ in lexical if id not in found]
+        if missing:
+            rest = self.docs_collection.get(ids=missing, include=["documents", "metadatas"])
+            for id, document, metadata in zip(rest["ids"], rest["documents"], rest["metadatas"]):
+                found[id] = (document, metadata, None)
+        fused = [
+            id for id in reciprocal_rank_fusion([dense["ids"][0], [id for id, _ in lexical]]) if id in found
+        ][:k]
+        return {
+            "ids": [fused],
+            "documents": [[found[id][0] for id in fused]],
+            "metadatas": [[found[id][1] for id in fused]],
+            "distances": [[found[id][2] for id in fused]],
+        }
+
+    def embed_texts(self, texts):
+        # Embed texts with the same embedding function as the collections
+        return self.embedding_function(texts)
+
+    def add_agent_metadata(self, agent_name, metadata, filename, replace=False):
+        """
+        Upsert agent metadata in the `agents` collection. The ids are hashes of the agent name, the metadata type
+        and the text, so adding the same metadata again is a no-op. With replace=True all the previous
+        metadata of the agent is deleted first, so only the new metadata is searched.
+        """
+        texts = [metadata[name] for name in AGENT_METADATA_TYPES]
+        attributes = self.agent_attributes.get(agent_name, {})
         metadatas = [
-            {"agent_name": agent_name, "filename": filename, "type": "capabilities"},
-            {"agent_name": agent_name, "filename": filename, "type": "description"},
-            {"agent_name": agent_name, "filename": filename, "type": "keywords"},
+            {"agent_name": agent_name, "filename": filename, "type": name, **attributes}
+            for name in AGENT_METADATA_TYPES
         ]
-        uuid_str = str(uuid.uuid4())
-        self.agents_collection.add(
+        ids = [
+            f"{agent_name}_{name}_{content_id(agent_name, name, text)}"
+            for name, text in zip(AGENT_METADATA_TYPES, texts)
+        ]
+        # The index is loaded before the upsert so the new vectors are added to it exactly once
+        index = self.get_agent_index() if self.use_agent_index else None
+        if replace:
+            self.agents_collection.delete(where={"agent_name": agent_name})
+            existing = set()
+        else:
+            existing = set(self.agents_collection.get(ids=ids, include=[])["ids"])
+        # Embed once, the same vectors go to the collection and to the agent index
+        embeddings = self.embed_texts(texts)
+        self.agents_collection.upsert(
             documents=texts,
+            embeddings=embeddings,
             metadatas=metadatas,
-            ids=[
-                f"{agent_name}_capabilities_{uuid_str}",
-                f"{agent_name}_description_{uuid_str}",
-                f"{agent_name}_keywords_{uuid_str}",
-            ],
+            ids=ids,
         )
+        if index is not None:
+            if replace:
+                index.remove(agent_name)
+            # Texts which were already stored are already part of the agent's centroid
+            new = [i for i, id in enumerate(ids) if id not in existing]
+            if new:
+                index.add(
+                    agent_name, [ids[i] for i in new], [embeddings[i] for i in new], [texts[i] for i in new], attributes
+                )
+
+    def set_agent_attributes(self, agent_name, attributes):
+        """
+        Store the filter attributes of an agent on its vectors and in the agent index.
+        Only the vectors whose metadata actually changes are written.
+        """
+        self.agent_attributes[agent_name] = {**self.agent_attributes.get(agent_name, {}), **attributes}
+        stored = self.agents_collection.get(where={"agent_name": agent_name}, include=["metadatas"])
+        changed = [
+            (id, {**metadata, **attributes})
+            for id, metadata in zip(stored["ids"], stored["metadatas"])
+            if any(metadata.get(key) != value for key, value in attributes.items())
+        ]
+        if changed:
+            self.agents_collection.update(
+                ids=[id for id, _ in changed], metadatas=[metadata for _, metadata in changed]
+            )
+        with self.agent_index_lock:
+            index = self.agent_index
+        if index is not None:
+            index.set_attributes(agent_name, attributes)
+
+    def compact(self, batch_size=1000) -> dict:
+        """
+        Rebuild both collections with one entry per unique content under its content-hash id.
+        Duplicates added under random ids by older versions are dropped. Each collection is copied
+        into <name>_compacted, which also rebuilds its HNSW index. Then the old collection is renamed to
+        <name>_backup, the copy takes its name and the backup is deleted, so an interruption at any point
+        leaves the data in a collection which _recover_compaction restores.
+        Returns the number of entries before and after for each collection.
+        """
+        stats = {}
+        for name, key in (
+            ("documents", lambda document, metadata: (
+                f"{metadata.get('filename', '')}_{content_id(metadata.get('filename', ''), document)}"
+            )),
+            ("agents", lambda document, metadata: (
+                f"{metadata['agent_name']}_{metadata['type']}_"
+                f"{content_id(metadata['agent_name'], metadata['type'], document)}"
+            )),
+        ):
+            self._recover_compaction(name)
+            collection = self.client.get_or_create_collection(name=name, embedding_function=self.embedding_function)
+            data = collection.get(include=["embeddings", "documents", "metadatas"])
+            entries = {}  # New id -> (document, metadata, embedding), the last entry of a duplicate wins
+            for document, metadata, embedding in zip(data["documents"], data["metadatas"], data["embeddings"]):
+                entries[key(document, metadata)] = (document, metadata, embedding)
+            compacted = self.client.create_collection(
+                name=f"{name}_compacted", embedding_function=self.embedding_function
+            )
+            items = list(entries.items())
+            for start in range(0, len(items), batch_size):
+                batch = items[start:start + batch_size]
+                compacted.add(
+                    ids=[id for id, _ in batch],
+                    documents=[document for _, (document, _, _) in batch],
+                    metadatas=[metadata for _, (_, metadata, _) in batch],
+                    embeddings=[embedding for _, (_, _, embedding) in batch],
+                )
+            collection.modify(name=f"{name}_backup")
+            compacted.modify(name=name)
+            self.client.delete_collection(f"{name}_backup")
+            stats[name] = {"before": len(data["ids"]), "after": len(items)}
+        self.docs_collection = self.client.get_collection(name="documents", embedding_function=self.embedding_function)
+        self.agents_collection = self.client.get_collection(name="agents", embedding_function=self.embedding_function)
+        if self.lexical_index is not None:
+            # The document ids changed, index them again
+            self.lexical_index.clear()
+            self._index_existing_docs()
+        with self.agent_index_lock:
+            self.agent_index = None  # Rebuilt without the duplicates on the next search
+        return stats
 
-    def similarity_search_agents(self, query_text, k=5):
+    def similarity_search_agents(self, query_text, k=5, where=None):
         print("Searching for similar agents...")
         print("Query:", query_text)
         print("k:", k)
         try:
+            if self.use_agent_index:
+                return self._search_agent_index([query_text], k, where)[0]
             results = self.agents_collection.query(
-                query_texts=[query_text], n_results=k
+                query_texts=[query_text], n_results=k, where=chroma_where(where)
             )
-            threshold = 1.5  # Set your desired threshold
-            filtered_results = {
-                'ids': [],
-                'documents': [],
-                'metadatas': [],
-                'distances': []
-            }
-
-            # Iterate through the results
-            for i, distances in enumerate(results['distances']):
-                for j, distance in enumerate(distances):
-                    if distance <= threshold:
-                        # Append the filtered items
-                        filtered_results['ids'].append(results['ids'][i][j])
-                        filtered_results['documents'].append(results['documents'][i][j])
-                        filtered_results['metadatas'].append(results['metadatas'][i][j])
-                        filtered_results['distances'].append(distance)
+            filtered_results = self._filter_agent_results(results, 0)
             print("Filtered results:", filtered_results)
             return filtered_results
         except Exception as e:
             print("ChromaDB error:", e)
             return None
+
+    def similarity_search_agents_batch(self, query_texts, k=5, where=None):
+        """
+        Search similar agents for many queries with a single multi-query call,
+        the queries are embedded in one batch. Returns one filtered result per query, in order.
+        """
+        if not query_texts:
+            return []
+        try:
+            if self.use_agent_index:
+                return self._search_agent_index(list(query_texts), k, where)
+            results = self.agents_collection.query(
+                query_texts=list(query_texts), n_results=k, where=chroma_where(where)
+            )
+            return [self._filter_agent_results(results, i) for i in range(len(query_texts))]
+        except Exception as e:
+            print("ChromaDB error:", e)
+            return [None] * len(query_texts)
@@ -0,0 +1,129 @@
+import os
+import re
+from collections import deque
+from itertools import islice
+
+WORD_PATTERN = re.compile(r"\S+")
+CONTROL_CHARACTERS = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f\x7f]")
+HYPHENATED_LINE_BREAK = re.compile(r"(\w)-\n(\w)")
+
+
+def read_pdf_pages(path):
+    """
+    Yields (page number, text) of each page of a PDF, one page in memory at a time
+    """
+    import fitz  # PyMuPDF, only needed when reading PDFs
+
+    with fitz.open(path) as doc:
+        for page_num in range(len(doc)):
+            yield page_num + 1, doc.load_page(page_num).get_text()
+
+
+def read_text_pages(path, block_chars=65536):
+    """
+    Yields (None, text) blocks of whole lines of a text file, so large files are never fully loaded
+    """
+    lines, size = [], 0
+    with open(path, encoding="utf-8", errors="replace") as file:
+        for line in file:
+            lines.append(line)
+            size += len(line)
+            if size >= block_chars:
+                yield None, "".join(lines)
+                lines, size = [], 0
+    if lines:
+        yield None, "".join(lines)
+
+
+def clean_text(text: str) -> str:
+    '''
+    Remove control characters and join words hyphenated across a line break.
+    '''
+    text = CONTROL_CHARACTERS.sub(" ", text)
+    return HYPHENATED_LINE_BREAK.sub(r"\1\2", text)
+
+
+def word_tokens(word: str) -> float:
+    # Same estimate as agent.catalog.estimate_tokens, about 4 characters per token including the space
+    return (len(word) + 1) / 4
+
+
+def chunk_pages(pages, chunk_tokens: int = 256, overlap_tokens: int = 32):
+    '''
+    Split (page, text) pairs into chunks of about `chunk_tokens` tokens, where consecutive chunks share
+    their last/first `overlap_tokens` tokens. Chunks can span pages. Yields dicts with the chunk 'text',
+    the 'page' and 'page_end' it spans and the character 'offset' of its first word in the cleaned page text.
+    Blocks without a page number (None) are parts of one text, their offsets are counted from its start.
+    Only the words of the current chunk are kept in memory.
+    '''
+    if overlap_tokens >= chunk_tokens:
+        raise ValueError("overlap_tokens has to be smaller than chunk_tokens")
+    window = deque()  # (word, page, offset) of the current chunk
+    window_tokens = 0.0
+    new_words = 0  # Words added since the last chunk, the overlap alone is not a chunk
+    text_offset = 0  # Offset of the current block in a text without pages
+    for page, text in pages:
+        text = clean_text(text)
+        base = 0 if page is not None else text_offset
+        text_offset += len(text)
+        for match in WORD_PATTERN.finditer(text):
+            word = match.group()
+            window.append((word, page, base + match.start()))
+            window_tokens += word_tokens(word)
+            new_words += 1
+            if window_tokens >= chunk_tokens:
+                yield _make_chunk(window)
+                new_words = 0
+                # Keep the last words of the chunk, about overlap_tokens tokens, as the start of the next one
+                while window and window_tokens - word_tokens(window[0][0]) >= overlap_tokens:
+                    window_tokens -= word_tokens(window.popleft()[0])
+    if new_words:
+        yield _make_chunk(window)
+
+
+def _make_chunk(window) -> dict:
+    return {
+        "text": " ".join(word for word, _, _ in window),
+        "page": window[0][1],
+        "page_end": window[-1][1],
+        "offset": window[0][2],
+    }
+
+
+def batched(iterable, size: int):
+    """
+    Yields lists of up to `size` items of an iterable
+    """
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def ingest_document(vector_store, path, chunk_tokens: int = 256, overlap_tokens: int = 32, batch_size: int = 64) -> int:
+    '''
+    Read, clean and chunk a PDF or text file and add the chunks to the documents of a vector store,
+    `batch_size` chunks at a time. Every step is a generator, so memory does not grow with the document size.
+    Each chunk keeps its provenance (filename, page, page_end, offset) in its metadata.
+    Returns the number of chunks.
+    '''
+    filename = os.path.basename(path)
+    pages = read_pdf_pages(path) if path.lower().endswith(".pdf") else read_text_pages(path)
+    count = 0
+    for batch in batched(chunk_pages(pages, chunk_tokens, overlap_tokens), batch_size):
+        vector_store.add_texts(
+            [chunk["text"] for chunk in batch],
+            filename,
+            metadatas=[_provenance(chunk) for chunk in batch],
+        )
+        count += len(batch)
+    print(f"Ingested {count} chunks of {filename}")
+    return count
+
+
+def _provenance(chunk) -> dict:
+    # Metadata values cannot be None in Chroma, text files have no pages
+    metadata = {"offset": chunk["offset"]}
+    if chunk["page"] is not None:
+        metadata["page"] = chunk["page"]
+        metadata["page_end"] = chunk["page_end"]
+    return metadata
@@ -0,0 +1,143 @@
+import time
+import sqlite3
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict
+
+
+def embedding_cache_key(model_name: str, text: str) -> str:
+    return f"{model_name}:{hashlib.sha256(text.encode('utf-8')).hexdigest()}"
+
+
+class EmbeddingCache:
+    '''
+    Cache of text embeddings keyed on the model name and the SHA-256 of the text.
+    An in-process LRU of at most `max_memory_entries` vectors sits in front of an optional SQLite table
+    of at most `max_disk_entries` vectors, stored as float32 blobs. When the table is full the least
+    recently used rows are deleted. Identical texts are then only embedded once, also across restarts.
+    The row count of the table is loaded once when it is opened and then kept in memory.
+    '''
+
+    def __init__(self, db_path: str = None, max_memory_entries: int = 10000, max_disk_entries: int = 1000000):
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.entries = OrderedDict()  # Key -> embedding, least recently used first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.connection = None
+        self.disk_count = 0  # Rows in the embeddings table
+        if db_path:
+            self.connection = sqlite3.connect(db_path, check_same_thread=False)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+            self.connection.commit()
+            self.disk_count = self.connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def get_many(self, model_name, texts) -> list:
+        """
+        Returns the cached embedding of each text, None for the texts which are not cached
+        """
+        keys = [embedding_cache_key(model_name, text) for text in texts]
+        results = [None] * len(keys)
+        with self.lock:
+            missing = []
+            for i, key in enumerate(keys):
+                embedding = self.entries.get(key)
+                if embedding is not None:
+                    self.entries.move_to_end(key)
+                    results[i] = embedding
+                else:
+                    missing.append(i)
+            for i, embedding in zip(missing, self._get_persistent([keys[i] for i in missing])):
+                if embedding is not None:
+                    self._put_memory(keys[i], embedding)
+                    results[i] = embedding
+                    self.disk_hits += 1
+            found = sum(result is not None for result in results)
+            self.hits += found
+            self.misses += len(keys) - found
+        return results
+
+    def put_many(self, model_name, texts, embeddings):
+        """
+        Add the embeddings of texts
+        """
+        keys = [embedding_cache_key(model_name, text) for text in texts]
+        with self.lock:
+            for key, embedding in zip(keys, embeddings):
+                self._put_memory(key, list(embedding))
+            if self.connection is not None:
+                now = time.time()
+                # A key is the model and the text, so a row which already exists holds the same vector
+                # and only its last_used is refreshed. The change count of the inserts gives the new rows.
+                changes = self.connection.total_changes
+                self.connection.executemany(
+                    "INSERT OR IGNORE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                    [(key, array("f", embedding).tobytes(), now) for key, embedding in zip(keys, embeddings)],
+                )
+                inserted = self.connection.total_changes - changes
+                if inserted < len(keys):
+                    self.connection.executemany(
+                        "UPDATE embeddings SET last_used=? WHERE key=?", [(now, key) for key in keys]
+                    )
+                self.disk_count += inserted
+                if self.disk_count > self.max_disk_entries:
+                    self._evict_persistent()
+                self.connection.commit()
+
+    def get(self, model_name, text):
+        return self.get_many(model_name, [text])[0]
+
+    def put(self, model_name, text, embedding):
+        self.put_many(model_name, [text], [embedding])
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "disk_size": self.disk_count,
+                "hits": self.hits,
+                "misses": self.misses,
+                "disk_hits": self.disk_hits,
+            }
+
+    def _put_memory(self, key, embedding):
+        self.entries[key] = embedding
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_memory_entries:
+            self.entries.popitem(last=False)
+
+    def _get_persistent(self, keys):
+        if self.connection is None or not keys:
+            return [None] * len(keys)
+        found = {}
+        # Stay below the SQLite limit of bound parameters per statement
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            for key, vector in self.connection.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", chunk
+            ):
+                embedding = array("f")
+                embedding.frombytes(vector)
+                found[key] = embedding.tolist()
+        if found:
+            # Mark the rows as recently used so the size-based eviction keeps them
+            now = time.time()
+            self.connection.executemany(
+                "UPDATE embeddings SET last_used=? WHERE key=?", [(now, key) for key in found]
+            )
+            self.connection.commit()
+        return [found.get(key) for key in keys]
+
+    def _evict_persistent(self):
+        cursor = self.connection.execute(
+            "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+            (self.disk_count - self.max_disk_entries,),
+        )
+        self.disk_count -= cursor.rowcount
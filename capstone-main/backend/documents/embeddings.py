@@ -1,45 +1,96 @@
+import time
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from langchain.embeddings.base import Embeddings
 from typing import List
 
 
 class HTTPEmbeddingModel(Embeddings):
-    def __init__(self, api_url: str = "http://127.0.0.1:1234/v1/embeddings", model_name: str = "nomic-embed-text-v1.5"):
+    def __init__(
+        self,
+        api_url: str = "http://127.0.0.1:1234/v1/embeddings",
+        model_name: str = "nomic-embed-text-v1.5",
+        cache=None,
+        batch_size: int = 64,
+        max_concurrency: int = 4,
+        max_retries: int = 3,
+        backoff_seconds: float = 0.5,
+        timeout: float = 60,
+    ):
         """
         Initialize with the base URL of the HTTP server and model name.
         
         :param api_url: The API endpoint that returns the embeddings.
         :param model_name: The model to use when making the request.
+        :param cache: Optional EmbeddingCache, texts which were already embedded by the model are not sent again.
+        :param batch_size: Number of texts sent as the list `input` of one request.
+        :param max_concurrency: Maximum number of batch requests in flight, also the size of the connection pool.
+        :param max_retries: Number of retries of a failed request, with exponential backoff starting at backoff_seconds.
+        :param timeout: Timeout of a single request in seconds.
         """
         self.api_url = api_url
         self.model_name = model_name
+        self.cache = cache
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.timeout = timeout
+        # Keep-alive connections shared by all requests, one per concurrent batch
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
     
     def get_embedding(self, text: str) -> List[float]:
         """
-        Get the embedding for a single piece of text by making an HTTP request.
+        Get the embedding for a single piece of text, from the cache or by making an HTTP request.
         
         :param text: The text to get embeddings for.
         :return: A list of floats representing the embedding.
         """
+        return self.embed_documents([text])[0]
+
+    def _request_embeddings(self, texts: List[str]) -> List[List[float]]:
+        # One request for a batch of texts, retried on connection errors, rate limits and server errors
         payload = {
             "model": self.model_name,
-            "input": text
+            "input": texts
         }
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.session.post(
+                    self.api_url, json=payload, headers={"Content-Type": "application/json"}, timeout=self.timeout
+                )
+                if response.status_code == 200:
+                    break
+                error = ValueError(f"Error getting embedding: {response.text}")
+                if response.status_code != 429 and response.status_code < 500:
+                    raise error
+            except requests.RequestException as e:
+                error = e
+            if attempt == self.max_retries:
+                raise error
+            time.sleep(self.backoff_seconds * 2 ** attempt)
 
-        response = requests.post(self.api_url, json=payload, headers={"Content-Type": "application/json"})
-        
-        if response.status_code != 200:
-            raise ValueError(f"Error getting embedding: {response.text}")
-        
         response_json = response.json()
 
-        # Extract the first embedding from the "data" field
+        # The embeddings are in the "data" field, each one with the index of its input
         embedding_data = response_json.get("data", [])
-        if len(embedding_data) == 0:
-            raise ValueError("No embeddings found in the response.")
+        if len(embedding_data) != len(texts):
+            raise ValueError(f"Expected {len(texts)} embeddings, got {len(embedding_data)}.")
+        embedding_data = sorted(embedding_data, key=lambda item: item.get("index", 0))
+        return [item.get("embedding", []) for item in embedding_data]
 
-        # Assuming we are interested in the first embedding returned
-        return embedding_data[0].get("embedding", [])
+    def _request_all(self, texts: List[str]) -> List[List[float]]:
+        # Split the texts in batches and request them concurrently, the embeddings keep the order of the texts
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        if len(batches) == 1:
+            return self._request_embeddings(batches[0])
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(batches))) as executor:
+            results = executor.map(self._request_embeddings, batches)
+            return [embedding for batch in results for embedding in batch]
     
     def embed_documents(self, texts: List[str]) -> List[List[float]]:
         """
@@ -48,10 +99,18 @@ class HTTPEmbeddingModel(Embeddings):
         :param texts: List of documents to embed.
         :return: A list of lists, where each inner list is an embedding.
         """
-        embeddings = []
-        for text in texts:
-            embedding = self.get_embedding(text)
-            embeddings.append(embedding)
+        if not texts:
+            return []
+        if self.cache is None:
+            return self._request_all(list(texts))
+        embeddings = self.cache.get_many(self.model_name, texts)
+        # Each distinct text which is not cached is requested once
+        missing = list(dict.fromkeys(text for text, embedding in zip(texts, embeddings) if embedding is None))
+        if missing:
+            fetched = self._request_all(missing)
+            self.cache.put_many(self.model_name, missing, fetched)
+            by_text = dict(zip(missing, fetched))
+            embeddings = [by_text[text] if embedding is None else embedding for text, embedding in zip(texts, embeddings)]
         return embeddings
     
     def embed_query(self, text: str) -> List[float]:
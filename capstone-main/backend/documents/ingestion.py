@@ -0,0 +1,132 @@
+import time
+import uuid
+import queue
+import threading
+from collections import OrderedDict
+from documents.metadata import MetadataExtractor
+
+
+class QueueFullError(Exception):
+    '''
+    Raised when an ingestion job is submitted while the queue is full.
+    '''
+    pass
+
+
+class IngestionJob:
+    '''
+    Class to represent a metadata ingestion job and its status.
+    The status goes from "queued" to "running" and then to "succeeded" or "failed".
+    '''
+
+    def __init__(self, agent_name, text, filename, replace=False):
+        self.job_id = str(uuid.uuid4())
+        self.agent_name = agent_name
+        self.text = text
+        self.filename = filename
+        self.replace = replace  # Replace the previous metadata of the agent instead of adding to it
+        self.status = "queued"
+        self.result = None  # The extracted metadata once the job succeeded
+        self.error = None  # The error message if the job failed
+        self.created_at = time.time()
+        self.finished_at = None
+
+    def to_dict(self):
+        return {
+            "job_id": self.job_id,
+            "agent_name": self.agent_name,
+            "filename": self.filename,
+            "replace": self.replace,
+            "status": self.status,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class IngestionQueue:
+    '''
+    Bounded worker pool which extracts and saves agent metadata in the background.
+    All workers share a single MetadataExtractor, so the LLM client and the vector store
+    are created once instead of on every request. Submitting to a full queue raises QueueFullError.
+    '''
+
+    def __init__(
+        self,
+        num_workers: int = 2,
+        max_queue_size: int = 100,
+        max_finished_jobs: int = 1000,
+        extractor_factory=MetadataExtractor,
+        on_success=None,
+    ):
+        self.extractor_factory = extractor_factory
+        self.on_success = on_success  # Called with the job after its metadata was saved, e.g. to invalidate caches
+        self.extractor = None  # Shared MetadataExtractor, created by the first job
+        self.extractor_lock = threading.Lock()
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.max_finished_jobs = max_finished_jobs
+        self.jobs = OrderedDict()  # Job id -> IngestionJob, in submission order
+        self.jobs_lock = threading.Lock()
+        self.workers = []
+        for i in range(num_workers):
+            worker = threading.Thread(
+                target=self._work, name=f"ingestion-worker-{i}", daemon=True
+            )
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, agent_name, text, filename="manual_text", replace=False) -> IngestionJob:
+        """
+        Queue a metadata extraction job and return it right away
+        """
+        job = IngestionJob(agent_name, text, filename, replace)
+        with self.jobs_lock:
+            try:
+                self.queue.put_nowait(job)
+            except queue.Full:
+                raise QueueFullError(
+                    f"Ingestion queue is full ({self.queue.maxsize} jobs), try again later."
+                )
+            self.jobs[job.job_id] = job
+            self._evict_finished_jobs()
+        return job
+
+    def get_job(self, job_id):
+        """
+        Get a job by its id, returns None if the job is unknown or was evicted
+        """
+        with self.jobs_lock:
+            return self.jobs.get(job_id)
+
+    def get_extractor(self) -> MetadataExtractor:
+        with self.extractor_lock:
+            if self.extractor is None:
+                self.extractor = self.extractor_factory()
+            return self.extractor
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            job.status = "running"
+            try:
+                job.result = self.get_extractor().extract_and_save_metadata_from_text(
+                    job.text, job.agent_name, job.filename, job.replace
+                )
+                job.status = "succeeded"
+                if self.on_success is not None:
+                    self.on_success(job)
+            except Exception as e:
+                print(f"Ingestion job {job.job_id} failed: {e}")
+                job.error = str(e)
+                job.status = "failed"
+            finally:
+                job.text = None  # The text is not needed anymore, free the memory
+                job.finished_at = time.time()
+                self.queue.task_done()
+
+    def _evict_finished_jobs(self):
+        # Only finished jobs are evicted, oldest first
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished_at is not None]
+        for job_id in finished[: max(0, len(finished) - self.max_finished_jobs)]:
+            del self.jobs[job_id]
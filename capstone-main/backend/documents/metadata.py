@@ -1,11 +1,12 @@
-import fitz  # PyMuPDF
-from langchain_openai import ChatOpenAI
 from database.vector_store import ChromaDBVectorStore
+from documents.chunking import read_pdf_pages, ingest_document
 from langchain_core.messages import HumanMessage, SystemMessage
 
 
 class MetadataExtractor:
-    def __init__(self, model="qwen2.5-coder-7b-instruct"):
+    def __init__(self, model="qwen2.5-coder-7b-instruct", vector_store=None):
+        from langchain_openai import ChatOpenAI
+
         self.client = ChatOpenAI(
             model=model,
             max_tokens=1024,
@@ -33,20 +34,27 @@ class MetadataExtractor:
             "additionalProperties": False,
         }
         self.llm = self.client.with_structured_output(json_schema, method="json_schema")
-        self.vector_store = ChromaDBVectorStore("database/chromadb")
+        # Pass the vector store used for the searches so its agent index sees the new metadata right away
+        if vector_store is None:
+            vector_store = ChromaDBVectorStore("database/chromadb")
+        self.vector_store = vector_store
 
     def extract_text_from_pdf(self, pdf_path):
         """Extract and combine text from a single PDF file."""
         combined_text = ""
         try:
-            with fitz.open(pdf_path) as doc:
-                for page_num in range(len(doc)):
-                    page = doc.load_page(page_num)
-                    combined_text += page.get_text()
+            combined_text = "".join(text for _, text in read_pdf_pages(pdf_path))
         except Exception as e:
             print(f"Error reading {pdf_path}: {e}")
         return combined_text
 
+    def index_document(self, path, chunk_tokens=256, overlap_tokens=32, batch_size=64):
+        """
+        Chunk a PDF or text file and add the chunks to the searchable documents, without loading the whole file.
+        Use this instead of passing the extracted text of large documents around as one string.
+        """
+        return ingest_document(self.vector_store, path, chunk_tokens, overlap_tokens, batch_size)
+
     def generate_llm_based_metadata(self, text, agent_name):
         """
         Generate aggregate metadata for a bot based on combined document text.
@@ -90,13 +98,14 @@ class MetadataExtractor:
 
         return metadata
 
-    def save_metadata(self, metadata, agent_name, filename):
+    def save_metadata(self, metadata, agent_name, filename, replace=False):
         self.vector_store.add_agent_metadata(
-            agent_name=agent_name, metadata=metadata, filename=filename
+            agent_name=agent_name, metadata=metadata, filename=filename, replace=replace
         )
 
     def extract_and_save_metadata_from_text(
-        self, text, agent_name, filename="manual_text"
+        self, text, agent_name, filename="manual_text", replace=False
     ):
         metadata = self.generate_llm_based_metadata(text, agent_name)
-        self.save_metadata(metadata, agent_name, filename)
+        self.save_metadata(metadata, agent_name, filename, replace)
+        return metadata
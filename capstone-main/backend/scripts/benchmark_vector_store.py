@@ -0,0 +1,84 @@
+"""
+Benchmark the NumPy vector store against Chroma on the same data.
+
+Run from the backend directory:
+    python -m scripts.benchmark_vector_store --collection documents --queries 200
+
+The embeddings of a Chroma collection are copied into NumPy collections (flat and IVF, for each
+quantization) and searched with the same query vectors, taken from the collection itself.
+Recall@k is measured against an exact float32 search, latencies are per query in milliseconds.
+"""
+import time
+import argparse
+import tempfile
+import numpy as np
+from database.numpy_store import SegmentCollection, normalize
+
+
+def timed_queries(search, queries, k):
+    latencies, ids = [], []
+    for query in queries:
+        start = time.perf_counter()
+        ids.append(search(query, k))
+        latencies.append((time.perf_counter() - start) * 1000)
+    return ids, np.array(latencies)
+
+
+def recall(found, truth):
+    return float(np.mean([len(set(f) & set(t)) / len(t) for f, t in zip(found, truth) if t]))
+
+
+def report(name, ids, latencies, truth):
+    print(
+        f"{name:<24} recall={recall(ids, truth):.3f} "
+        f"p50={np.percentile(latencies, 50):.2f}ms p95={np.percentile(latencies, 95):.2f}ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chroma-path", default="database/chromadb")
+    parser.add_argument("--collection", default="documents", choices=["documents", "agents"])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--nprobe", type=int, default=8)
+    args = parser.parse_args()
+
+    from chromadb import PersistentClient
+
+    collection = PersistentClient(path=args.chroma_path).get_collection(args.collection)
+    data = collection.get(include=["embeddings", "documents", "metadatas"])
+    ids = list(data["ids"])
+    if not ids:
+        raise SystemExit(f"The {args.collection} collection is empty.")
+    embeddings = normalize(data["embeddings"])
+    rng = np.random.default_rng(0)
+    queries = embeddings[rng.choice(len(ids), min(args.queries, len(ids)), replace=False)]
+    k = min(args.k, len(ids))
+    print(f"{len(ids)} vectors of dimension {embeddings.shape[1]}, {len(queries)} queries, k={k}")
+
+    # Exact float32 search as the ground truth
+    truth = [[ids[i] for i in np.argsort(-(embeddings @ query))[:k]] for query in queries]
+
+    chroma_ids, latencies = timed_queries(
+        lambda query, k: collection.query(query_embeddings=[query.tolist()], n_results=k)["ids"][0], queries, k
+    )
+    report("chroma", chroma_ids, latencies, truth)
+
+    for quantization in ("int8", "float16", None):
+        for index in ("flat", "ivf"):
+            with tempfile.TemporaryDirectory() as path:
+                numpy_collection = SegmentCollection(
+                    path, quantization, index=index, nprobe=args.nprobe, ivf_min_vectors=len(ids) + 1
+                )
+                numpy_collection.add(ids, data["documents"], embeddings, data["metadatas"])
+                if index == "ivf":
+                    numpy_collection.train()
+                numpy_ids, latencies = timed_queries(
+                    lambda query, k: numpy_collection.query([query], k)["ids"][0], queries, k
+                )
+                report(f"numpy {index} {quantization or 'float32'}", numpy_ids, latencies, truth)
+
+
+if __name__ == "__main__":
+    main()
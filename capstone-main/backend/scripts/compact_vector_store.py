@@ -0,0 +1,26 @@
+"""
+Compact the Chroma vector store: keep one entry per unique content and rebuild the collections.
+
+Run from the backend directory while the backend is stopped:
+    python -m scripts.compact_vector_store
+
+Entries are re-keyed on the content-hash ids used by ChromaDBVectorStore, so the duplicates added
+by repeated uploads under random ids are dropped, and each collection is rebuilt from scratch.
+"""
+import argparse
+from database.vector_store import ChromaDBVectorStore
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chroma-path", default="database/chromadb")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    stats = ChromaDBVectorStore(args.chroma_path, use_agent_index=False).compact(batch_size=args.batch_size)
+    for name, counts in stats.items():
+        print(f"{name}: {counts['before']} -> {counts['after']} entries")
+
+
+if __name__ == "__main__":
+    main()
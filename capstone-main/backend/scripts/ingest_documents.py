@@ -0,0 +1,32 @@
+"""
+Chunk PDF or text files and add the chunks to the documents of the Chroma vector store.
+
+Run from the backend directory:
+    python -m scripts.ingest_documents ../archive/manuals/*.pdf --chunk-tokens 256 --overlap-tokens 32
+
+Files are streamed page by page and the chunks are added in batches, so large manuals never have to
+fit in memory. Each chunk keeps its filename, page and offset in its metadata.
+"""
+import argparse
+from database.vector_store import ChromaDBVectorStore
+from documents.chunking import ingest_document
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument("--chroma-path", default="database/chromadb")
+    parser.add_argument("--chunk-tokens", type=int, default=256)
+    parser.add_argument("--overlap-tokens", type=int, default=32)
+    parser.add_argument("--batch-size", type=int, default=64)
+    args = parser.parse_args()
+
+    vector_store = ChromaDBVectorStore(args.chroma_path, use_agent_index=False)
+    total = 0
+    for path in args.paths:
+        total += ingest_document(vector_store, path, args.chunk_tokens, args.overlap_tokens, args.batch_size)
+    print(f"Ingested {total} chunks of {len(args.paths)} files.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Train the tier-0 router from labeled query logs and save it as a new versioned artifact.
+
+Run from the backend directory:
+    python -m scripts.train_router \
+        --data ../archive/expanded_synthetic_queries_500.csv:Questions:Bots \
+        --data ../archive/output.csv:Question:ResponseGuid
+
+Each --data is a CSV file with the name of its question column and its label column.
+By default only labels which are agents in the database are kept, as other labels can never be routed to.
+"""
+import os
+import csv
+import argparse
+from agent.router import train_router, artifact_version
+from database.database import SQLLiteDatabase
+
+
+def read_labeled_queries(spec):
+    path, question_column, label_column = spec.rsplit(":", 2)
+    questions, labels = [], []
+    with open(path, newline="", encoding="utf-8") as file:
+        for row in csv.DictReader(file):
+            question = (row.get(question_column) or "").strip()
+            label = (row.get(label_column) or "").strip()
+            if question and label:
+                questions.append(question)
+                labels.append(label)
+    return questions, labels
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data", action="append", required=True, help="path.csv:question_column:label_column")
+    parser.add_argument("--output-dir", default="database/router")
+    parser.add_argument("--db", default="database/sqllite.db", help="Agent database used to filter the labels")
+    parser.add_argument("--all-labels", action="store_true", help="Keep labels which are not agents in the database")
+    parser.add_argument("--target-precision", type=float, default=0.95)
+    parser.add_argument("--epochs", type=int, default=30)
+    args = parser.parse_args()
+
+    questions, labels = [], []
+    for spec in args.data:
+        data_questions, data_labels = read_labeled_queries(spec)
+        questions += data_questions
+        labels += data_labels
+    if not args.all_labels:
+        agent_names = {agent.name for agent in SQLLiteDatabase(args.db).get_all_agents()}
+        kept = [i for i, label in enumerate(labels) if label in agent_names]
+        print(f"Keeping {len(kept)} of {len(labels)} queries whose label is a known agent.")
+        questions = [questions[i] for i in kept]
+        labels = [labels[i] for i in kept]
+    if len(set(labels)) < 2:
+        raise SystemExit("At least two different labels are needed to train the router.")
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    existing = [artifact_version(name) for name in os.listdir(args.output_dir)]
+    version = max(existing, default=0) + 1
+    router, stats = train_router(
+        questions, labels, epochs=args.epochs, target_precision=args.target_precision, version=version
+    )
+    path = os.path.join(args.output_dir, f"tier0_router_v{version}.npz")
+    router.save(path)
+    print(f"Saved {path} ({len(router.labels)} labels, {len(router.vocabulary)} terms)")
+    print("Held-out:", stats)
+
+
+if __name__ == "__main__":
+    main()
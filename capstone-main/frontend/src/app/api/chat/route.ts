@@ -0,0 +1,20 @@
+// Proxies the triage stages streamed by the backend (GET /agents/stream) as server-sent events,
+// so the chat can show the rewritten query, the clarify decision, the candidates and the final agent as they arrive.
+export async function GET(request: Request) {
+  const { searchParams } = new URL(request.url);
+  const apiUrl = process.env.NEXT_PUBLIC_API_URL || "http://localhost:8000";
+
+  const response = await fetch(`${apiUrl}/agents/stream?${searchParams.toString()}`, {
+    headers: { Accept: "text/event-stream" },
+  });
+
+  return new Response(response.body, {
+    status: response.status,
+    headers: {
+      // Error responses, e.g. 503 while the backend is loading, are JSON
+      "Content-Type": response.headers.get("Content-Type") ?? "text/event-stream",
+      "Cache-Control": "no-cache",
+      Connection: "keep-alive",
+    },
+  });
+}
@@ -27,6 +27,9 @@ export default function Chat() {
   const [messages, setMessages] = useState<Message[]>([]);
   const [input, setInput] = useState("");
   const [isLoading, setIsLoading] = useState(false);
+  const [sessionId, setSessionId] = useState<string | null>(null);
+  // Latest triage stage streamed by the backend, shown while waiting for the result
+  const [progress, setProgress] = useState<string | null>(null);
   const messagesEndRef = useRef<HTMLDivElement>(null);
   const inputRef = useRef<HTMLTextAreaElement>(null);
 
@@ -63,17 +66,26 @@ export default function Chat() {
     setInput("");
 
     try {
+      // The triage stages are streamed as server-sent events through the /api/chat proxy
       const response = await fetch(
-        `http://localhost:8000/agents?query=${encodeURIComponent(input)}`,
+        `/api/chat?query=${encodeURIComponent(input)}${
+          sessionId ? `&session_id=${encodeURIComponent(sessionId)}` : ""
+        }`,
         {
           method: "GET",
           headers: {
-            "Content-Type": "application/json",
+            Accept: "text/event-stream",
           },
         }
       );
 
-      const data = await response.json();
+      if (!response.ok || !response.body) {
+        // Error bodies, e.g. 503 while the backend is loading, have no session_id
+        const error = await response.json().catch(() => ({}));
+        throw new Error(error.detail ?? `Request failed with status ${response.status}`);
+      }
+      const data = await readTriageStream(response.body);
+      setSessionId(data.session_id);
 
       const assistantMessage: Message = {
         content: {
@@ -94,9 +106,41 @@ export default function Chat() {
       console.error("Error:", error);
     } finally {
       setIsLoading(false);
+      setProgress(null);
     }
   };
 
+  // Reads the server-sent events of the triage, shows each stage as progress and returns the 'result' data
+  const readTriageStream = async (body: ReadableStream<Uint8Array>) => {
+    const reader = body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+    while (true) {
+      const { done, value } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+      const blocks = buffer.split("\n\n");
+      buffer = blocks.pop() ?? "";
+      for (const block of blocks) {
+        let event = "message";
+        let data = "";
+        for (const line of block.split("\n")) {
+          if (line.startsWith("event: ")) event = line.slice(7);
+          else if (line.startsWith("data: ")) data += line.slice(6);
+        }
+        const payload = data ? JSON.parse(data) : {};
+        if (event === "result") return payload;
+        if (event === "error") throw new Error(payload.detail ?? "The triage failed.");
+        if (event === "rewritten_query") setProgress(`Searching for: ${payload.query}`);
+        else if (event === "can_answer")
+          setProgress(payload.can_answer ? "Staying with the current agent..." : "Looking for a better agent...");
+        else if (event === "candidates" && payload.agents?.length > 0)
+          setProgress(`Comparing agents: ${payload.agents.join(", ")}`);
+      }
+    }
+    throw new Error("The triage stream ended without a result.");
+  };
+
   const handleKeyDown = (e: React.KeyboardEvent) => {
     if (e.key === "Enter" && !e.shiftKey) {
       e.preventDefault();
@@ -105,6 +149,12 @@ export default function Chat() {
   };
 
   const clearChat = () => {
+    if (sessionId) {
+      fetch(`http://localhost:8000/sessions/${encodeURIComponent(sessionId)}`, {
+        method: "DELETE",
+      }).catch((error) => console.error("Error:", error));
+    }
+    setSessionId(null);
     setMessages([]);
   };
 
@@ -247,6 +297,12 @@ export default function Chat() {
             </div>
           </div>
         ))}
+        {isLoading && (
+          <div className="flex items-center space-x-2 text-sm text-gray-500">
+            <Loader2 className="h-4 w-4 animate-spin" />
+            <span>{progress ?? "Routing your query..."}</span>
+          </div>
+        )}
         <div ref={messagesEndRef} />
       </div>
 